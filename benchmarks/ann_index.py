@@ -0,0 +1,74 @@
+"""Recall@k, search latency and memory of the FAISS index types selectable in LLM.DB.INDEX.TYPE.
+
+Run from the project root:
+    python -m benchmarks.ann_index --chunks 100000 --dim 1536 --types flat ivf_flat ivf_pq hnsw
+
+The corpus is synthetic: chunks are scattered around random topic centers, queries are perturbed chunks.
+Recall is measured against the exact Flat results, index parameters come from conf.json. Past the nearest one,
+a query's neighbours are other chunks of the same topic at nearly equal distances, so recall@k is a strict test for PQ.
+"""
+import time
+import argparse
+import statistics
+
+import faiss
+import numpy as np
+
+from llm.db import create_index, index_factory_string
+
+TOPICS = 1_000
+
+
+def corpus(chunks: int, dim: int, queries: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(TOPICS, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, TOPICS, chunks)] + rng.normal(scale=0.6, size=(chunks, dim)).astype(np.float32)
+    picked = vectors[rng.integers(0, chunks, queries)]
+    return vectors, picked + rng.normal(scale=0.3, size=picked.shape).astype(np.float32)
+
+
+def measure(index: faiss.Index, queries: np.ndarray, k: int) -> tuple[np.ndarray, float, float]:
+    timings = []
+    results = []
+    for query in queries:
+        started = time.perf_counter()
+        _, indices = index.search(query.reshape(1, -1), k)
+        timings.append((time.perf_counter() - started) * 1e3)
+        results.append(indices[0])
+    timings.sort()
+    return np.stack(results), statistics.median(timings), timings[int(len(timings) * 0.99)]
+
+
+def recall(found: np.ndarray, truth: np.ndarray) -> float:
+    return float(np.mean([len(set(row) & set(expected)) / len(expected) for row, expected in zip(found, truth)]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=1_000)
+    parser.add_argument("-k", type=int, default=4)
+    parser.add_argument("--types", nargs="+", default=["flat", "ivf_flat", "ivf_pq", "hnsw"])
+    args = parser.parse_args()
+
+    vectors, queries = corpus(args.chunks, args.dim, args.queries)
+    print(f"\n{args.chunks:,} chunks x {args.dim} dims, {args.queries} queries, k={args.k}")
+    print(f"{'index':>24} | {'build s':>8} | {'recall@1':>8} | {'recall@k':>8} | {'p50 ms':>7} | {'p99 ms':>7} | {'memory MB':>9}")
+
+    truth = None
+    for index_type in ["flat"] + [t for t in args.types if t != "flat"]:
+        started = time.perf_counter()
+        index = create_index(vectors, index_type)
+        built = time.perf_counter() - started
+        found, p50, p99 = measure(index, queries, args.k)
+        truth = found if truth is None else truth
+        memory = faiss.serialize_index(index).nbytes / 2 ** 20
+        name = index_factory_string(index_type, args.chunks, args.dim)
+        if index_type == "flat" and "flat" not in args.types:
+            continue
+        print(f"{name:>24} | {built:>8.1f} | {recall(found[:, :1], truth[:, :1]):>8.3f} | {recall(found, truth):>8.3f} | {p50:>7.2f} | {p99:>7.2f} | {memory:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Lookup latency of UserDatabase.get_summary / load_message_history as history grows.
+
+Run from the project root:
+    python -m benchmarks.db_lookups --rows 10000 100000 1000000 3000000 --schema 1 <current version>
+
+Schema v1 is measured with the original subquery lookups, later schemas through UserDatabase.
+"""
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+import aiosqlite
+
+from db import UserDatabase
+from db.relational.pool import ConnectionPool
+from db.relational.writer import WriteBehindQueue
+from db.relational.migrations import migrate, MIGRATIONS
+
+USERS = 10_000
+LOOKUPS = 2_000
+
+LEGACY_QUERIES = {
+    "get_summary": "SELECT summary FROM message_summaries WHERE user_id=(SELECT id FROM users WHERE tg_id=?) ORDER BY id DESC LIMIT 1;",
+    "load_message_history": "SELECT message, role FROM message_history WHERE user_id=(SELECT id FROM users WHERE tg_id=?) ORDER BY id DESC LIMIT 6;",
+}
+
+
+async def create_schema(path: str, schema: int):
+    async with aiosqlite.connect(path) as db:
+        await migrate(db, target=schema)
+
+
+def fill(path: str, schema: int, rows: int, start: int):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL;")
+    db.execute("PRAGMA synchronous=OFF;")
+    if start == 0:
+        db.executemany("INSERT INTO users (tg_id, username) VALUES (?, ?);",
+                       ((tg_id, str(tg_id)) for tg_id in range(1, USERS + 1)))
+
+    batch = 100_000
+    for offset in range(start, rows, batch):
+        count = min(batch, rows - offset)
+        db.executemany("INSERT INTO message_history (user_id, message, role) VALUES (?, ?, ?);",
+                       ((random.randint(1, USERS), "Сообщение " * 20, "user") for _ in range(count)))
+        if schema >= 2:
+            db.executemany("INSERT INTO message_summaries (user_id, summary) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET summary=excluded.summary;",
+                           ((random.randint(1, USERS), "Резюме " * 50) for _ in range(count // 2)))
+        else:
+            db.executemany("INSERT INTO message_summaries (user_id, summary) VALUES (?, ?);",
+                           ((random.randint(1, USERS), "Резюме " * 50) for _ in range(count // 2)))
+        db.commit()
+    db.close()
+
+
+async def measure(method) -> tuple[float, float]:
+    timings = []
+    for _ in range(LOOKUPS):
+        tg_id = random.randint(1, USERS)
+        UserDatabase.SUMMARIES.clear()
+        started = time.perf_counter()
+        await method(tg_id)
+        timings.append((time.perf_counter() - started) * 1e6)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99)]
+
+
+async def run(rows_steps: list[int], schema: int):
+    directory = tempfile.mkdtemp(prefix="kia_bench_")
+    path = os.path.join(directory, "bench.sqlite")
+    await create_schema(path, schema)
+
+    pool = ConnectionPool(path, 4, 128, {"journal_mode": "WAL", "synchronous": "NORMAL", "busy_timeout": 5000})
+    UserDatabase.POOL = pool
+    UserDatabase.WRITES = WriteBehindQueue(pool, 200, 100)
+
+    print(f"\nschema v{schema} ({path})")
+    print(f"{'history rows':>14} | {'get_summary p50/p99 us':>24} | {'load_history p50/p99 us':>25}")
+    filled = 0
+    for rows in sorted(rows_steps):
+        fill(path, schema, rows, filled)
+        filled = rows
+        await pool.open()
+        if schema == 1:
+            summary = await measure(lambda tg_id: UserDatabase.execute_query(LEGACY_QUERIES["get_summary"], tg_id))
+            history = await measure(lambda tg_id: UserDatabase.execute_query(LEGACY_QUERIES["load_message_history"], tg_id))
+        else:
+            summary = await measure(UserDatabase.get_summary)
+            history = await measure(lambda tg_id: UserDatabase.load_message_history(tg_id, limit=6))
+        await pool.close()
+        print(f"{rows:>14,} | {summary[0]:>11.0f} / {summary[1]:>10.0f} | {history[0]:>12.0f} / {history[1]:>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--schema", type=int, nargs="+", default=[len(MIGRATIONS)])
+    args = parser.parse_args()
+    for schema in args.schema:
+        asyncio.run(run(args.rows, schema))
+
+
+if __name__ == "__main__":
+    main()
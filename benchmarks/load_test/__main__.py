@@ -0,0 +1,258 @@
+"""End-to-end load test: main.py's dispatcher against local Telegram Bot API and OpenAI stand-ins.
+
+Run from the project root:
+    python -m benchmarks.load_test --users 50 --messages 5 --completion-latency 0.8 --error-rate 0.01
+    python -m benchmarks.load_test --mode webhook --completion-latency 0 --embedding-latency 0
+    python -m benchmarks.load_test --workers 4 --completion-latency 0 --embedding-latency 0
+    python -m benchmarks.load_test --telegram-limits --flood-rate 0.05 --answer-chars 10000
+
+The bot runs in a temporary working directory with its own conf.json, SQLite database and FAISS index,
+nothing is sent to Telegram or OpenAI. Each simulated user sends its messages one after another, a turn
+lasts from the update becoming available to getUpdates (or being POSTed to the webhook) until get_message
+returns. With zero stub latencies the difference between the modes is the update delivery overhead.
+With --workers the handlers run in worker processes, a turn then ends with the reply's sendMessage and
+streaming is switched off, so there is one per turn. Stage timings stay in the workers and aren't reported.
+Like the OpenAI limits, the send queue's Telegram rate limits are lifted unless --telegram-limits is given.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+from aiohttp import ClientSession, web
+
+from .openai_stub import ANSWER, OpenAIStub
+from .telegram_stub import TelegramStub
+
+QUESTIONS = [
+    "Какой расход топлива у Kia Sportage?",
+    "Сколько стоит ТО для Kia Rio?",
+    "Какие комплектации есть у Kia Sorento?",
+    "Где найти ближайший дилерский центр?",
+    "Есть ли сейчас скидки на Kia Seltos?",
+    "Как обновить навигацию в Kia Ceed?",
+    "Какая гарантия на новый автомобиль?",
+    "Подскажите, какой двигатель у Kia K5?",
+]
+MODELS = ["Rio", "Ceed", "Cerato", "K5", "Sportage", "Sorento", "Seltos", "Soul", "Carnival", "Mohave"]
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def report_stages(turns: int) -> None:
+    # Stage timings come from the bot's own metrics, quantiles are estimated from the histogram buckets.
+    from metrics import METRICS
+    from metrics.registry import format_labels
+
+    print(f"\n{'stage':>40} | {'calls':>6} | {'per turn ms':>11} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8}")
+    for name, series in sorted(METRICS.histograms.items()):
+        for labels, histogram in sorted(series.items()):
+            per_turn = histogram.sum / turns * 1e3 if turns else 0.0
+            print(f"{name + format_labels(labels):>40} | {histogram.count:>6} | {per_turn:>11.1f} | {histogram.quantile(0.5) * 1e3:>8.1f} | "
+                  f"{histogram.quantile(0.95) * 1e3:>8.1f} | {histogram.quantile(0.99) * 1e3:>8.1f}")
+
+
+async def warm_up_workers(telegram_stub: TelegramStub, replies: dict[int, asyncio.Future], args: argparse.Namespace) -> None:
+    # Worker readiness isn't observable from here, one throwaway message per worker waits out their startup.
+    futures = {}
+    for user_id in range(args.workers):
+        futures[user_id] = replies[user_id] = asyncio.get_running_loop().create_future()
+        telegram_stub.push_message(user_id, QUESTIONS[0])
+    await asyncio.wait_for(asyncio.gather(*futures.values()), args.timeout * 10)
+
+
+def knowledge_base(sections: int) -> str:
+    lines = []
+    for i in range(sections):
+        model = MODELS[i % len(MODELS)]
+        lines.append(f"## Kia {model} {i}")
+        for topic in ("Двигатель", "Комплектации", "Сервис"):
+            lines.append(f"### {topic}")
+            lines.append(" ".join(f"Kia {model} {i}, {topic.lower()}: пункт {j}. Подробности уточняйте у официального дилера."
+                                  for j in range(10)))
+    return "\n".join(lines)
+
+
+def prepare_workdir(root: str, args: argparse.Namespace) -> str:
+    directory = tempfile.mkdtemp(prefix="kia_load_")
+    with open(f"{root}/conf.json") as file:
+        conf = json.load(file)
+    conf["BOT"]["STREAMING"]["ENABLED"] = args.streaming and not args.workers
+    conf["LLM"]["ANSWER_CACHE"]["ENABLED"] = args.answer_cache
+    conf["METRICS"]["ENABLED"] = False
+    if not args.openai_limits:
+        # The stub has no quota, the scheduler's RPM/TPM budget would otherwise dominate every turn.
+        conf["LLM"]["SCHEDULER"].update(RPM=1_000_000, TPM=100_000_000)
+    if not args.telegram_limits:
+        conf["BOT"]["SEND_QUEUE"].update(RATE=1_000_000, BURST=1_000_000, CHAT_INTERVAL=0, GROUP_CHAT_INTERVAL=0)
+    with open(f"{directory}/conf.json", "w") as file:
+        json.dump(conf, file, ensure_ascii=False, indent=2)
+
+    texts_dir = conf["LLM"]["DB"]["TEXTS_DIR"]
+    for path in (texts_dir, conf["LLM"]["DB"]["EMBEDDINGS_DIR"], conf["DB"]["RELATIONAL"]["DATABASE_DIR"]):
+        os.makedirs(f"{directory}/{path}", exist_ok=True)
+    for name in conf["LLM"]["DB"]["FILES"]:
+        if os.path.exists(source := f"{root}/{texts_dir}/{name}") and not args.synthetic_kb:
+            shutil.copy(source, f"{directory}/{texts_dir}/{name}")
+        else:
+            with open(f"{directory}/{texts_dir}/{name}", "w") as file:
+                file.write(knowledge_base(args.kb_sections))
+    return directory
+
+
+async def serve(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+async def run(args: argparse.Namespace) -> None:
+    root = os.getcwd()
+    sys.path.insert(0, root)
+
+    turns: dict[tuple[int, int], asyncio.Future] = {}
+    replies: dict[int, asyncio.Future] = {}
+
+    def replied(chat_id: int):
+        if (future := replies.pop(chat_id, None)) is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    answer = "\n\n".join([ANSWER] * max(1, args.answer_chars // (len(ANSWER) + 2)))
+    openai_stub = OpenAIStub(args.completion_latency, args.embedding_latency, args.error_rate, args.rate_limit_rate, answer=answer)
+    telegram_stub = TelegramStub(on_reply=replied if args.workers else None, flood_rate=args.flood_rate)
+    openai_runner, openai_url = await serve(openai_stub.app())
+    telegram_runner, telegram_url = await serve(telegram_stub.app())
+    os.environ.update(OPENAI_API_KEY="sk-load-test", OPENAI_BASE_URL=f"{openai_url}/v1", OPENAI_API_BASE=f"{openai_url}/v1",
+                      BOT_TOKEN="42:load-test", TELEGRAM_API_URL=telegram_url)
+    os.environ.setdefault("LOGGING_END_USERS", "")
+    os.environ.update(LOAD_TEST_ROOT=root, LOAD_TEST_LOG_LEVEL=args.log_level)
+
+    # log reads log/conf.json relative to the project root, error alerts must not reach the real chat.
+    import log.handlers
+    from log import logger
+    log.handlers.BOT_TOKEN = None
+    logger.setLevel(args.log_level)
+
+    workdir = prepare_workdir(root, args)
+    os.chdir(workdir)
+    import main
+    from llm.db import wait_index_ready
+    from .worker import run_worker
+
+    async def track(handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            if (future := turns.pop((event.chat.id, event.message_id), None)) is not None and not future.done():
+                future.set_result(time.perf_counter())
+
+    main.dp.message.middleware(track)
+    bot = main.make_bot()
+    setup_started = time.perf_counter()
+    client = ClientSession()
+    dispatcher = main.make_supervisor(args.workers, run_worker).dispatcher if args.workers else main.dp
+    if args.mode == "webhook":
+        webhook_runner, webhook_url = await serve(main.webhook_app(bot, dispatcher))
+        webhook_url += main.WEBHOOK_CONFIG["PATH"]
+    else:
+        polling = asyncio.create_task(dispatcher.start_polling(bot, handle_signals=False, polling_timeout=1,
+                                                               allowed_updates=main.dp.resolve_used_update_types()))
+        await asyncio.sleep(0)
+    if args.workers:
+        await warm_up_workers(telegram_stub, replies, args)
+    else:
+        await wait_index_ready(args.timeout * 10)
+    print(f"Bot ready in {time.perf_counter() - setup_started:.1f}s, working directory {workdir}")
+
+    latencies: list[float] = []
+    timeouts = 0
+
+    async def user(user_id: int):
+        nonlocal timeouts
+        for _ in range(args.messages):
+            await asyncio.sleep(random.uniform(0, args.think_time))
+            future = asyncio.get_running_loop().create_future()
+            pushed = time.perf_counter()
+            update = telegram_stub.make_update(user_id, random.choice(QUESTIONS))
+            if args.workers:
+                replies[user_id] = future
+            else:
+                turns[(user_id, update["message"]["message_id"])] = future
+            if args.mode == "webhook":
+                async with client.post(webhook_url, json=update) as response:
+                    response.raise_for_status()
+            else:
+                telegram_stub.push_update(update)
+            try:
+                latencies.append(await asyncio.wait_for(future, args.timeout) - pushed)
+            except asyncio.TimeoutError:
+                timeouts += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(1_000_000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    if args.mode == "webhook":
+        await webhook_runner.cleanup()
+    else:
+        await dispatcher.stop_polling()
+        await polling
+    await client.close()
+    await openai_runner.cleanup()
+    await telegram_runner.cleanup()
+    os.chdir(root)
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    streaming = args.streaming and not args.workers
+    print(f"\n{args.users} users x {args.messages} messages, {args.mode}, {args.workers or 'no'} workers, "
+          f"streaming {'on' if streaming else 'off'}")
+    print(f"{len(latencies)} turns in {elapsed:.1f}s: {len(latencies) / elapsed:.1f} msgs/s, {timeouts} timed out")
+    if latencies:
+        print(f"turn latency ms: p50 {percentile(latencies, 0.5) * 1e3:.0f}, p95 {percentile(latencies, 0.95) * 1e3:.0f}, "
+              f"p99 {percentile(latencies, 0.99) * 1e3:.0f}, mean {statistics.mean(latencies) * 1e3:.0f}")
+    if not args.workers:
+        report_stages(len(latencies))
+    print(f"\nOpenAI stub: {dict(openai_stub.calls)}")
+    print(f"Telegram stub: {dict(telegram_stub.calls)}, longest text {telegram_stub.longest}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling", help="how updates reach the bot")
+    parser.add_argument("--workers", type=int, default=0, help="run handlers in this many worker processes")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=5, help="messages per user")
+    parser.add_argument("--think-time", type=float, default=1.0, help="max pause before each message, seconds")
+    parser.add_argument("--completion-latency", type=float, default=0.8, help="mean chat completion latency, seconds")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="mean embeddings latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of OpenAI calls answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of OpenAI calls answered with 429")
+    parser.add_argument("--no-streaming", dest="streaming", action="store_false")
+    parser.add_argument("--no-answer-cache", dest="answer_cache", action="store_false")
+    parser.add_argument("--openai-limits", action="store_true", help="keep the RPM/TPM limits from conf.json")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the send queue rate limits from conf.json")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of sendMessage/editMessageText answered with 429")
+    parser.add_argument("--answer-chars", type=int, default=0, help="repeat the canned answer in paragraphs up to this length")
+    parser.add_argument("--synthetic-kb", action="store_true", help="use a generated knowledge base even if db/text exists")
+    parser.add_argument("--kb-sections", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=60.0, help="per turn, seconds")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
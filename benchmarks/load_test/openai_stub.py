@@ -0,0 +1,106 @@
+import json
+import time
+import base64
+import random
+import asyncio
+import hashlib
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+from aiohttp import web
+
+ANSWER = ("Kia Sorento доступен с бензиновым двигателем 2.5 MPI и дизельным 2.2 CRDi. "
+          "Уточните, пожалуйста, интересующую комплектацию, и я подскажу подробности по оснащению и стоимости.")
+
+
+class OpenAIStub:
+    # OpenAI-compatible /v1/chat/completions and /v1/embeddings with canned answers, injected latency and errors.
+
+    def __init__(self, completion_latency: float, embedding_latency: float, error_rate: float, rate_limit_rate: float,
+                 dim: int = 1536, answer: str = ANSWER, stream_chunks: int = 20) -> None:
+        self.completion_latency = completion_latency
+        self.embedding_latency = embedding_latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.dim = dim
+        self.answer = answer
+        self.stream_chunks = stream_chunks
+        self.calls: Counter[str] = Counter()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        return app
+
+    def vector(self, item) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha1(json.dumps(item, ensure_ascii=False).encode()).digest()[:8], "little")
+        vector = np.random.default_rng(seed).normal(size=self.dim).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def failure(self, kind: str) -> Optional[web.Response]:
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            self.calls[f"{kind}_429"] += 1
+            return web.json_response({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                                     status=429, headers={"retry-after-ms": "200"})
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.calls[f"{kind}_500"] += 1
+            return web.json_response({"error": {"message": "Injected failure", "type": "server_error", "code": None}}, status=500)
+        return None
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.calls["embeddings"] += 1
+        await asyncio.sleep(self.embedding_latency * random.uniform(0.5, 1.5))
+        if (response := self.failure("embeddings")) is not None:
+            return response
+
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        # LangChain sends token ids, the openai client plain strings, both hash to a stable vector.
+        if inputs and isinstance(inputs[0], int):
+            inputs = [inputs]
+        data = []
+        for i, item in enumerate(inputs):
+            vector = self.vector(item)
+            embedding = base64.b64encode(vector.tobytes()).decode() if body.get("encoding_format") == "base64" else vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(item) if isinstance(item, list) else len(item) // 4 for item in inputs)
+        return web.json_response({"object": "list", "data": data, "model": body.get("model", "text-embedding-ada-002"),
+                                  "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.calls["chat"] += 1
+        if (response := self.failure("chat")) is not None:
+            await asyncio.sleep(self.completion_latency * 0.1)
+            return response
+
+        prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4
+        completion_tokens = len(self.answer) // 4
+        meta = {"id": f"chatcmpl-{random.getrandbits(64):x}", "created": int(time.time()), "model": body["model"]}
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.completion_latency * random.uniform(0.5, 1.5))
+            return web.json_response({
+                **meta, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.answer}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        size = -(-len(self.answer) // self.stream_chunks)
+        pieces = [self.answer[i:i + size] for i in range(0, len(self.answer), size)]
+        delay = self.completion_latency * random.uniform(0.5, 1.5) / (len(pieces) + 1)
+        for piece in pieces + [None]:
+            await asyncio.sleep(delay)
+            delta = {"content": piece} if piece is not None else {}
+            chunk = {**meta, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": None if piece is not None else "stop"}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
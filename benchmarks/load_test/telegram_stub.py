@@ -0,0 +1,95 @@
+import time
+import random
+import asyncio
+import itertools
+from collections import Counter
+from typing import Any, Callable, Optional
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Kia", "username": "kia_load_test_bot"}
+
+
+class TelegramStub:
+    # Just enough of the Bot API for long polling and replies, served at /bot{token}/{method}.
+    # flood_rate is the share of sendMessage and editMessageText calls refused with 429 and retry_after.
+
+    def __init__(self, on_reply: Optional[Callable[[int], None]] = None, flood_rate: float = 0.0, retry_after: int = 1) -> None:
+        self.calls: Counter[str] = Counter()
+        self.on_reply = on_reply
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.longest = 0
+        self._updates: list[dict] = []
+        self._arrived: Optional[asyncio.Event] = None
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def make_update(self, user_id: int, text: str) -> dict[str, Any]:
+        return {"update_id": next(self._update_ids), "message": {
+            "message_id": next(self._message_ids), "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+        }}
+
+    def push_update(self, update: dict[str, Any]) -> None:
+        self._updates.append(update)
+        self.arrived.set()
+
+    def push_message(self, user_id: int, text: str) -> int:
+        update = self.make_update(user_id, text)
+        self.push_update(update)
+        return update["message"]["message_id"]
+
+    @property
+    def arrived(self) -> asyncio.Event:
+        if self._arrived is None:
+            self._arrived = asyncio.Event()
+        return self._arrived
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.content_type != "application/json" else await request.json()
+        self.calls[method] += 1
+        if method in ("sendMessage", "editMessageText"):
+            self.longest = max(self.longest, len(params.get("text", "")))
+            if random.random() < self.flood_rate:
+                self.calls[f"{method}_429"] += 1
+                return web.json_response({"ok": False, "error_code": 429, "parameters": {"retry_after": self.retry_after},
+                                          "description": f"Too Many Requests: retry after {self.retry_after}"}, status=429)
+        handler = getattr(self, f"on_{method}", None)
+        result = await handler(params) if handler is not None else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def on_getMe(self, params: dict) -> dict:
+        return BOT_USER
+
+    async def on_getUpdates(self, params: dict) -> list[dict]:
+        offset = int(params.get("offset") or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get("limit") or 100)]
+
+    async def on_sendMessage(self, params: dict) -> dict:
+        if self.on_reply is not None:
+            self.on_reply(int(params["chat_id"]))
+        return self.message(params, next(self._message_ids))
+
+    async def on_editMessageText(self, params: dict) -> dict:
+        return self.message(params, int(params["message_id"]))
+
+    @staticmethod
+    def message(params: dict, message_id: int) -> dict[str, Any]:
+        chat_id = int(params["chat_id"])
+        return {"message_id": message_id, "date": int(time.time()), "text": params.get("text", ""),
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
@@ -0,0 +1,15 @@
+import os
+
+
+def run_worker(number: int, workers: int, updates):
+    # Worker processes start fresh: log has to be imported from the project root and alerts switched off again.
+    workdir = os.getcwd()
+    os.chdir(os.environ["LOAD_TEST_ROOT"])
+    import log.handlers
+    from log import logger
+    log.handlers.BOT_TOKEN = None
+    logger.setLevel(os.environ["LOAD_TEST_LOG_LEVEL"])
+    os.chdir(workdir)
+
+    import main
+    main.run_worker(number, workers, updates)
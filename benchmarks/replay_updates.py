@@ -0,0 +1,75 @@
+"""Record Telegram updates and replay them against a bot running in webhook mode.
+
+Run from the project root:
+    python -m benchmarks.replay_updates record updates.jsonl
+    BOT_MODE=webhook python main.py
+    python -m benchmarks.replay_updates replay updates.jsonl --url http://127.0.0.1:8080/webhook
+
+record drains pending updates of BOT_TOKEN with getUpdates, so it only works while no webhook is set.
+replay POSTs them one JSON update per line, the way Telegram delivers them, with WEBHOOK_SECRET as the
+secret token header, and reports the webhook response times. Replies go to the real chats of the recording.
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+from aiohttp import ClientSession
+from dotenv import load_dotenv
+
+
+async def record(args: argparse.Namespace) -> None:
+    url = f"https://api.telegram.org/bot{os.environ['BOT_TOKEN']}/getUpdates"
+    offset, count = 0, 0
+    async with ClientSession() as session:
+        with open(args.file, "a") as file:
+            while True:
+                async with session.post(url, json={"offset": offset, "timeout": args.timeout}) as response:
+                    updates = (await response.json())["result"]
+                if not updates:
+                    break
+                for update in updates:
+                    file.write(json.dumps(update, ensure_ascii=False) + "\n")
+                offset, count = updates[-1]["update_id"] + 1, count + len(updates)
+    print(f"Recorded {count} updates to {args.file}")
+
+
+async def replay(args: argparse.Namespace) -> None:
+    with open(args.file) as file:
+        updates = [json.loads(line) for line in file if line.strip()]
+    headers = {"X-Telegram-Bot-Api-Secret-Token": os.environ["WEBHOOK_SECRET"]} if os.getenv("WEBHOOK_SECRET") else {}
+    latencies = []
+    async with ClientSession(headers=headers) as session:
+        started = time.perf_counter()
+        for update in updates:
+            posted = time.perf_counter()
+            async with session.post(args.url, json=update) as response:
+                response.raise_for_status()
+            latencies.append(time.perf_counter() - posted)
+            if args.interval:
+                await asyncio.sleep(args.interval)
+        elapsed = time.perf_counter() - started
+    if latencies:
+        print(f"Replayed {len(updates)} updates in {elapsed:.2f}s, response ms: mean {statistics.mean(latencies) * 1e3:.1f}, "
+              f"max {max(latencies) * 1e3:.1f}")
+
+
+def main():
+    load_dotenv(".env")
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    recorder = commands.add_parser("record", help="append pending updates from getUpdates to a file")
+    recorder.add_argument("file")
+    recorder.add_argument("--timeout", type=int, default=0, help="long polling timeout, seconds")
+    player = commands.add_parser("replay", help="POST recorded updates to the webhook")
+    player.add_argument("file")
+    player.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    player.add_argument("--interval", type=float, default=0.0, help="pause between updates, seconds")
+    args = parser.parse_args()
+    asyncio.run(record(args) if args.command == "record" else replay(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
+import os
+import json
+import dotenv
 from aiogram.types import Message, CallbackQuery, ContentType
 from aiogram.methods import SendChatAction
 from aiogram import Dispatcher
@@ -5,9 +8,23 @@ from aiogram.filters.command import Command
 from aiogram import F
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from llm import LLM
+from llm.db import wait_index_ready
 from db import UserDatabase
+from .streaming import answer_streaming
+from .summarizer import SUMMARIZER
 
 from log import logger
+from metrics import METRICS
+
+with open("conf.json", "r") as file:
+    logger.debug("Loading bot config")
+    config = json.load(file)["BOT"]
+
+STREAMING = config["STREAMING"]
+INDEX_WAIT_TIMEOUT = config["INDEX_WAIT_TIMEOUT"]
+
+dotenv.load_dotenv(".env")
+ADMIN_USERS = {int(user_id) for user_id in os.getenv("ADMIN_USERS", "").split(",") if user_id}
 
 
 async def get_start(message: Message) -> None:
@@ -23,26 +40,45 @@ async def get_button_delete_history(message: Message):
     await message.answer("История сообщений успешно удалена!")
 
 
+async def get_stats(message: Message) -> None:
+    if message.from_user.id not in ADMIN_USERS:
+        return
+    await message.answer(METRICS.summary() or "Пока нет данных")
+
+
+@METRICS.timed("turn_seconds")
 async def get_message(message: Message) -> None:
     user_id = message.from_user.id
     await message.bot.send_chat_action(message.chat.id, "typing")
+    if not await wait_index_ready(INDEX_WAIT_TIMEOUT):
+        logger.warning("FAISS index is still loading, answering without documents")
 
-    summary = await UserDatabase.get_summary(user_id)
-    response, documents, success = await LLM.ask(message.text, summary)
-    await message.answer(response, disable_web_page_preview=True)
+    await SUMMARIZER.wait(user_id)
+    summary, last_message_id = await UserDatabase.get_summary_state(user_id)
+    history = await UserDatabase.load_message_history(user_id, last_message_id, LLM.CONTEXT.max_messages + 1)
+    if len(history) > LLM.CONTEXT.max_messages:
+        # Only while the summarizer catches up, e.g. after failed summary calls.
+        logger.warning(f"User {user_id} has over {LLM.CONTEXT.max_messages} unsummarized messages, the oldest are left out of the context")
+        history = history[-LLM.CONTEXT.max_messages:]
+    if STREAMING["ENABLED"]:
+        stream = await LLM.ask(message.text, summary, history, stream=True)
+        response = await answer_streaming(message, stream, STREAMING["EDIT_INTERVAL"])
+        success = stream.success
+    else:
+        response, documents, success = await LLM.ask(message.text, summary, history)
+        await message.answer(response, disable_web_page_preview=True)
 
+    METRICS.inc("turns_total", status="ok" if success else "error")
     if success:
         await UserDatabase.save_message(user_id, message.text, "user")
         await UserDatabase.save_message(user_id, response, "assistant")
-
-        new_summary, success = await LLM.summarize_history(summary, message.text, response)
-        if success:
-            logger.info(f"{new_summary=}")
-            await UserDatabase.save_summary(user_id, new_summary)
+        if LLM.CONTEXT.over_budget(history + [(None, message.text, "user"), (None, response, "assistant")]):
+            SUMMARIZER.submit(user_id)
 
 
 def register_handlers(dp: Dispatcher) -> None:
     dp.message.register(get_start, Command(commands=["start"]))
+    dp.message.register(get_stats, Command(commands=["stats"]))
     dp.message.register(get_button_delete_history, F.text ==
                         "Очистить историю сообщений")
     dp.message.register(get_message)
@@ -1,7 +1,47 @@
+import asyncio
 from aiogram import Dispatcher
 from aiogram.types import Update
-from typing import Callable, Awaitable, Any
+from typing import Callable, Awaitable, Any, Optional
 from db import UserDatabase
+from metrics import METRICS
+
+
+class InFlight:
+    # Counts updates being handled, so shutdown can wait for them before the database is closed.
+
+    def __init__(self) -> None:
+        self.count = 0
+        self._idle: Optional[asyncio.Event] = None
+
+    @property
+    def idle(self) -> asyncio.Event:
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            self._idle.set()
+        return self._idle
+
+    async def __call__(self, handler: Callable[[Update, dict[str, Any]], Awaitable[Any]], event: Update, data: dict[str, Any]):
+        self.count += 1
+        self.idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if not self.count:
+                self.idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self) -> dict[str, int]:
+        return {"in_flight": self.count}
+
+
+IN_FLIGHT = InFlight()
 
 
 async def register_users(handler: Callable[[Update, dict[str, Any]], Awaitable[Any]], event: Update, data: dict[str, Any]):
@@ -10,4 +50,8 @@ async def register_users(handler: Callable[[Update, dict[str, Any]], Awaitable[A
 
 
 def register_middlewares(dp: Dispatcher):
+    dp.update.outer_middleware(IN_FLIGHT)
     dp.update.middleware(register_users)
+
+
+METRICS.gauges_from("updates", IN_FLIGHT.stats)
@@ -0,0 +1,216 @@
+import json
+import time
+import asyncio
+import itertools
+from typing import Any, Optional, Union
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendChatAction, SendMessage, TelegramMethod
+
+from log import logger
+from metrics import METRICS
+
+with open("conf.json", "r") as file:
+    logger.debug("Loading send queue config")
+    SEND_QUEUE_CONFIG = json.load(file)["BOT"]["SEND_QUEUE"]
+
+MESSAGE_LIMIT = 4096
+
+# Lower goes first. Methods not listed here aren't tied to a chat's limits and skip the queue, getUpdates among them.
+REPLY, EDIT, ACTION = 0, 1, 2
+PRIORITIES = {SendMessage: REPLY, EditMessageText: EDIT, SendChatAction: ACTION}
+PRIORITY_NAMES = {REPLY: "reply", EDIT: "edit", ACTION: "action"}
+
+
+def message_length(text: str) -> int:
+    # Telegram counts UTF-16 code units, characters outside the BMP such as most emoji count twice.
+    return len(text.encode("utf-16-le")) // 2
+
+
+def fitting_prefix(text: str, limit: int) -> int:
+    units = 0
+    for i, char in enumerate(text):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > limit:
+            return i
+    return len(text)
+
+
+def split_point(text: str, limit: int = MESSAGE_LIMIT) -> int:
+    # The last paragraph break that fits, then line break, then space, a hard cut only for a single huge word.
+    fit = fitting_prefix(text, limit)
+    return next((i for separator in ("\n\n", "\n", " ") if (i := text.rfind(separator, 0, fit + 1)) > 0), fit)
+
+
+def split_text(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    parts = []
+    while message_length(text) > limit:
+        cut = split_point(text, limit)
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+class SendQueue(BaseRequestMiddleware):
+    # Bot session middleware that lets chat-bound requests out in priority order under Telegram's flood limits:
+    # a global token bucket, a minimum interval between messages to the same chat and retry_after holds per chat.
+    # Requests that hit flood control anyway wait out retry_after and are queued again ahead of newer ones.
+
+    def __init__(self, rate: float, burst: int, chat_interval: float, group_chat_interval: float, max_retries: int,
+                 chat_action_ttl: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.chat_interval = chat_interval
+        self.group_chat_interval = group_chat_interval
+        self.max_retries = max_retries
+        self.chat_action_ttl = chat_action_ttl
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._waiting: list[tuple[int, int, Union[int, str], float, asyncio.Future]] = []
+        self._next_send: dict[Union[int, str], float] = {}
+        self._actions: set[Union[int, str]] = set()
+        self._order = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def share(self, workers: int) -> None:
+        # Worker processes each send through their own bot session, the global limit is split between them.
+        self.rate /= workers
+        self.burst = max(1, self.burst // workers)
+        self._tokens = float(self.burst)
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+        if (priority := PRIORITIES.get(type(method))) is None:
+            return await make_request(bot, method)
+        if isinstance(method, SendMessage) and message_length(method.text) > MESSAGE_LIMIT and not method.entities:
+            return await self.send_parts(make_request, bot, method)
+        if priority == ACTION:
+            return await self.send_action(make_request, bot, method)
+
+        order = next(self._order)
+        for attempt in itertools.count():
+            await self.turn(priority, method.chat_id, order)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as ex:
+                if attempt >= self.max_retries:
+                    raise
+                self.hold(method.chat_id, ex.retry_after)
+                self.retried += 1
+                METRICS.inc("send_retries_total", method=PRIORITY_NAMES[priority])
+                logger.warning(f"Flood control in chat {method.chat_id}, retrying {type(method).__name__} in {ex.retry_after}s")
+
+    async def send_parts(self, make_request: NextRequestMiddlewareType, bot: Bot, method: SendMessage) -> Any:
+        # Parts go out in order, the keyboard is attached to the last one, which is returned.
+        parts = split_text(method.text)
+        for i, part in enumerate(parts):
+            result = await self(make_request, bot, method.model_copy(update={
+                "text": part, "reply_markup": method.reply_markup if i == len(parts) - 1 else None}))
+        return result
+
+    async def send_action(self, make_request: NextRequestMiddlewareType, bot: Bot, method: SendChatAction) -> Any:
+        # A chat action already waiting covers this one, and one that waited past its TTL would show up after the reply.
+        if method.chat_id in self._actions:
+            return True
+        self._actions.add(method.chat_id)
+        try:
+            if not await self.turn(ACTION, method.chat_id, next(self._order)):
+                self.dropped += 1
+                return True
+        finally:
+            self._actions.discard(method.chat_id)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as ex:
+            self.hold(method.chat_id, ex.retry_after)
+            self.dropped += 1
+            return True
+
+    async def turn(self, priority: int, chat_id: Union[int, str], order: int) -> bool:
+        # Resolves when the request may be sent, False for a chat action that expired while waiting.
+        # A retried request keeps its order, so it goes before requests queued after it.
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch(), name="sendQueue")
+        queued = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((priority, order, chat_id, queued, future))
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            METRICS.observe("send_wait_seconds", time.monotonic() - queued, priority=PRIORITY_NAMES[priority])
+
+    def hold(self, chat_id: Union[int, str], seconds: float) -> None:
+        self._next_send[chat_id] = max(self._next_send.get(chat_id, 0.0), time.monotonic() + seconds)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        for *_, future in self._waiting:
+            future.cancel()
+        self._waiting.clear()
+
+    def stats(self) -> dict[str, Any]:
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, *_ in self._waiting:
+            depth[PRIORITY_NAMES[priority]] += 1
+        return {"depth": depth, "sent": self.sent, "retried": self.retried, "dropped_actions": self.dropped,
+                "held_chats": sum(1 for until in self._next_send.values() if until > time.monotonic())}
+
+    def _interval(self, chat_id: Union[int, str]) -> float:
+        # Groups and channels have negative ids or @usernames and a stricter per-chat limit.
+        return self.group_chat_interval if isinstance(chat_id, str) or chat_id < 0 else self.chat_interval
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            # The queue holds at most a few requests per chat being answered, a scan is cheaper than keeping it sorted.
+            self._waiting = [entry for entry in self._waiting if not entry[4].done()]
+            ready = [entry for entry in self._waiting if self._next_send.get(entry[2], 0.0) <= now]
+            if not ready:
+                await self._sleep(min((self._next_send[entry[2]] - now for entry in self._waiting), default=None))
+                continue
+            if self._tokens < 1:
+                await self._sleep((1 - self._tokens) / self.rate)
+                continue
+
+            entry = min(ready)
+            priority, _, chat_id, queued, future = entry
+            self._waiting.remove(entry)
+            if priority == ACTION and now - queued > self.chat_action_ttl:
+                future.set_result(False)
+                continue
+            self._tokens -= 1
+            self.sent += 1
+            if priority != ACTION:
+                self._next_send[chat_id] = now + self._interval(chat_id)
+            if len(self._next_send) > 10_000:
+                self._next_send = {chat: until for chat, until in self._next_send.items() if until > now}
+            future.set_result(True)
+
+    async def _sleep(self, timeout: Optional[float]) -> None:
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+SEND_QUEUE = SendQueue(SEND_QUEUE_CONFIG["RATE"], SEND_QUEUE_CONFIG["BURST"], SEND_QUEUE_CONFIG["CHAT_INTERVAL"],
+                       SEND_QUEUE_CONFIG["GROUP_CHAT_INTERVAL"], SEND_QUEUE_CONFIG["MAX_RETRIES"], SEND_QUEUE_CONFIG["CHAT_ACTION_TTL"])
+METRICS.gauges_from("send_queue", SEND_QUEUE.stats)
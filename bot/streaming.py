@@ -0,0 +1,68 @@
+import time
+from typing import Optional
+from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest
+
+from llm.api import AnswerStream
+from log import logger
+from .outbound import MESSAGE_LIMIT, message_length, split_point
+
+
+async def answer_streaming(message: Message, stream: AnswerStream, edit_interval: float) -> str:
+    reply: Message | None = None
+    shown = ""
+    # Where the current reply starts in stream.text, answers over MESSAGE_LIMIT go on in new messages.
+    start = 0
+    last_edit = 0.0
+
+    async for _ in stream:
+        start, reply, shown = await roll_over(message, stream.text, start, reply, shown)
+        # A rolled-over message starts after the paragraph break at the cut.
+        text = stream.text[start:].lstrip()
+        if not text:
+            continue
+        if reply is None:
+            reply = await message.answer(text, disable_web_page_preview=True)
+            shown, last_edit = text, time.monotonic()
+        elif time.monotonic() - last_edit >= edit_interval:
+            shown = await edit_reply(reply, text, shown)
+            last_edit = time.monotonic()
+
+    if not stream.success and start > 0:
+        # The error text replaced the answer, the parts already sent stay and the error follows them.
+        await message.answer(stream.text, disable_web_page_preview=True)
+        return stream.text
+    start, reply, shown = await roll_over(message, stream.text, start, reply, shown)
+    # After a roll-over the rest can be just the whitespace at the cut, Telegram refuses empty messages.
+    if not (text := stream.text[start:].lstrip()):
+        return stream.text
+    if reply is None:
+        await message.answer(text, disable_web_page_preview=True)
+    else:
+        await edit_reply(reply, text, shown)
+    return stream.text
+
+
+async def roll_over(message: Message, text: str, start: int, reply: Optional[Message], shown: str) -> tuple[int, Optional[Message], str]:
+    # Completes the current reply up to a paragraph boundary once the text outgrows it, the rest starts a new one.
+    while message_length(text[start:]) > MESSAGE_LIMIT:
+        cut = start + split_point(text[start:])
+        if not (part := text[start:cut].lstrip()):
+            pass
+        elif reply is None:
+            await message.answer(part, disable_web_page_preview=True)
+        else:
+            await edit_reply(reply, part, shown)
+        start, reply, shown = cut, None, ""
+    return start, reply, shown
+
+
+async def edit_reply(reply: Message, text: str, shown: str) -> str:
+    if text == shown:
+        return shown
+    try:
+        await reply.edit_text(text, disable_web_page_preview=True)
+    except TelegramBadRequest as ex:
+        logger.warning(f"Couldn't edit streamed reply. {ex}")
+        return shown
+    return text
@@ -0,0 +1,102 @@
+import json
+import asyncio
+
+from db import UserDatabase
+from llm import LLM
+from log import logger
+from metrics import METRICS
+
+with open("conf.json", "r") as file:
+    logger.debug("Loading summarizer config")
+    SUMMARIZER_CONFIG = json.load(file)["BOT"]["SUMMARIZER"]
+
+
+class SummaryWorker:
+
+    def __init__(self, concurrency: int, wait_timeout: float) -> None:
+        self.concurrency = concurrency
+        self.wait_timeout = wait_timeout
+        self._pending: set[int] = set()
+        self._done: dict[int, asyncio.Event] = {}
+        self._queue: asyncio.Queue[int] | None = None
+        self._workers: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._work(), name=f"summaryWorker{i}") for i in range(self.concurrency)]
+
+    async def stop(self, timeout: float) -> None:
+        # A summary call stuck in OpenAI retries mustn't hold shutdown past the supervisor's stop timeout,
+        # unfinished users are summarized again after their next message.
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Summaries of {len(self._done)} users still pending after {timeout}s, cancelling them")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        logger.info("Summary worker stopped")
+
+    def submit(self, user_id: int) -> None:
+        # A user is queued at most once, turns arriving meanwhile are compacted in the same call.
+        self._pending.add(user_id)
+        if user_id not in self._done:
+            self._done[user_id] = asyncio.Event()
+            self._queue.put_nowait(user_id)
+
+    def stats(self) -> dict[str, int]:
+        return {"queued": self._queue.qsize() if self._queue is not None else 0, "users": len(self._done)}
+
+    async def wait(self, user_id: int) -> None:
+        if (done := self._done.get(user_id)) is None:
+            return
+        try:
+            await asyncio.wait_for(done.wait(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            logger.debug(f"Summary for {user_id} is still pending, using the last saved one")
+
+    async def _work(self) -> None:
+        while True:
+            user_id = await self._queue.get()
+            try:
+                await self._summarize(user_id)
+            except Exception as ex:
+                logger.error(f"Error summarizing history of {user_id}. {ex}")
+            finally:
+                if user_id in self._pending:
+                    self._queue.put_nowait(user_id)
+                else:
+                    self._done.pop(user_id).set()
+                self._queue.task_done()
+
+    @METRICS.timed("summary_seconds")
+    async def _summarize(self, user_id: int) -> None:
+        self._pending.discard(user_id)
+        await UserDatabase.flush()
+        summary, last_message_id = await UserDatabase.get_summary_state(user_id)
+        # Unsummarized rows are compacted oldest first, max_messages at a time, so a backlog left by failed
+        # summary calls is caught up in order instead of being skipped.
+        batch = LLM.CONTEXT.max_messages
+        while True:
+            history = await UserDatabase.load_message_history(user_id, last_message_id, batch + 1, oldest=True)
+            history = [row for row in history if row[0] is not None]
+            if len(history) > batch:
+                compacted = history[:batch]
+            else:
+                compacted, _ = LLM.CONTEXT.split(history)
+            if not compacted:
+                return
+
+            new_summary, success = await LLM.summarize_history(summary, compacted)
+            if not success:
+                return
+            logger.info(f"{new_summary=}")
+            summary, last_message_id = new_summary, compacted[-1][0]
+            await UserDatabase.save_summary(user_id, summary, last_message_id)
+
+
+SUMMARIZER = SummaryWorker(SUMMARIZER_CONFIG["CONCURRENCY"], SUMMARIZER_CONFIG["WAIT_TIMEOUT"])
+METRICS.gauges_from("summarizer", SUMMARIZER.stats)
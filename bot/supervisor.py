@@ -0,0 +1,84 @@
+import time
+import asyncio
+import multiprocessing
+from typing import Any, Callable, Optional
+from aiogram import Dispatcher
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import Update
+
+from log import logger
+
+
+class Supervisor:
+    # Receives the update stream and hands every update to one of N worker processes, chosen by the sender's
+    # id, so a user's messages are handled in order by the process that holds their caches.
+    # target(number, workers, updates) runs in the worker and reads serialized updates until it gets None.
+
+    def __init__(self, workers: int, target: Callable[[int, int, Any], None], restart_delay: float, stop_timeout: float) -> None:
+        self.context = multiprocessing.get_context("spawn")
+        self.target = target
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.queues = [self.context.Queue() for _ in range(workers)]
+        self.processes: list[Optional[multiprocessing.Process]] = [None] * workers
+        self.restarts = [0] * workers
+        self.routed = [0] * workers
+        self.dispatcher = Dispatcher()
+        self.dispatcher.update.outer_middleware(self.route)
+        self._monitor: Optional[asyncio.Task] = None
+
+    def shard(self, update: Update) -> int:
+        user = getattr(update.event, "from_user", None)
+        return hash(user.id if user is not None else update.update_id) % len(self.queues)
+
+    async def route(self, handler: Callable, event: Update, data: dict[str, Any]):
+        number = self.shard(event)
+        self.queues[number].put(event.model_dump_json(exclude_unset=True))
+        self.routed[number] += 1
+        return UNHANDLED
+
+    async def start(self) -> None:
+        for number in range(len(self.queues)):
+            self._spawn(number)
+        self._monitor = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        for queue in self.queues:
+            queue.put(None)
+        await asyncio.to_thread(self._join)
+        logger.info(f"Workers stopped {self.stats()}")
+
+    def stats(self) -> dict[str, Any]:
+        return {"workers": len(self.queues), "routed": sum(self.routed), "restarts": sum(self.restarts)}
+
+    def _spawn(self, number: int) -> None:
+        process = self.context.Process(target=self.target, args=(number, len(self.queues), self.queues[number]), name=f"worker-{number}", daemon=True)
+        process.start()
+        self.processes[number] = process
+        logger.info(f"Started worker {number}, pid {process.pid}")
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.restart_delay)
+            for number, process in enumerate(self.processes):
+                if not process.is_alive():
+                    self.restarts[number] += 1
+                    logger.error(f"Worker {number} exited with code {process.exitcode}, restarting")
+                    # A crashed worker may die holding its queue's read lock, so the replacement gets a new queue.
+                    # Updates it was running or still had queued are lost.
+                    self.queues[number].close()
+                    self.queues[number].cancel_join_thread()
+                    self.queues[number] = self.context.Queue()
+                    self._spawn(number)
+
+    def _join(self) -> None:
+        deadline = time.monotonic() + self.stop_timeout
+        for number, process in enumerate(self.processes):
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker {number} didn't stop in {self.stop_timeout}s, terminating")
+                process.terminate()
+                process.join()
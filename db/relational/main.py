@@ -1,10 +1,14 @@
-import os
 import json
-import asyncio
-import aiosqlite
-from typing import Any, Literal
+import time
+from typing import Any, Literal, Optional
 
 from log import logger
+from metrics import METRICS
+from .pool import ConnectionPool
+from .writer import WriteBehindQueue
+from .maintenance import Maintenance
+from .migrations import migrate
+from .cache import LRUCache, MISSING
 
 with open("conf.json", "r") as file:
     logger.debug("Loading relational db config")
@@ -12,58 +16,132 @@ with open("conf.json", "r") as file:
 
 DATABASE_DIR = conf["DB"]["RELATIONAL"]["DATABASE_DIR"]
 DATABASE_NAME = conf["DB"]["RELATIONAL"]["DATABASE_NAME"]
+POOL_CONFIG = conf["DB"]["RELATIONAL"]["POOL"]
+WRITE_BEHIND_CONFIG = conf["DB"]["RELATIONAL"]["WRITE_BEHIND"]
+CACHE_CONFIG = conf["DB"]["RELATIONAL"]["CACHE"]
+MAINTENANCE_CONFIG = conf["DB"]["RELATIONAL"]["MAINTENANCE"]
 
 
 class UserDatabase:
     DATABASE_PATH = f"{DATABASE_DIR}/{DATABASE_NAME}"
+    POOL = ConnectionPool(DATABASE_PATH, POOL_CONFIG["READERS"], POOL_CONFIG["CACHED_STATEMENTS"], POOL_CONFIG["PRAGMAS"])
+    WRITES = WriteBehindQueue(POOL, WRITE_BEHIND_CONFIG["FLUSH_INTERVAL_MS"], WRITE_BEHIND_CONFIG["MAX_ROWS"])
+    KNOWN_USERS = LRUCache(CACHE_CONFIG["USERS"]["MAX_SIZE"], CACHE_CONFIG["USERS"]["TTL"])
+    SUMMARIES = LRUCache(CACHE_CONFIG["SUMMARIES"]["MAX_SIZE"], CACHE_CONFIG["SUMMARIES"]["TTL"])
+    MAINTENANCE = Maintenance(POOL, MAINTENANCE_CONFIG["INTERVAL"], MAINTENANCE_CONFIG["FIRST_RUN_DELAY"], MAINTENANCE_CONFIG["HISTORY_MAX_AGE_DAYS"],
+                              MAINTENANCE_CONFIG["HISTORY_KEEP_ROWS"], MAINTENANCE_CONFIG["USERS_PER_SLICE"], MAINTENANCE_CONFIG["VACUUM_PAGES"],
+                              MAINTENANCE_CONFIG["PAUSE_MS"])
 
     @classmethod
     async def create(cls):
-        async with aiosqlite.connect(cls.DATABASE_PATH) as db:
-            await db.execute("CREATE TABLE if not exists users (id INTEGER PRIMARY KEY AUTOINCREMENT, tg_id TEXT UNIQUE, username TEXT);")
-            await db.execute("CREATE TABLE if not exists message_history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INT NOT NULL, message TEXT NOT NULL, role TEXT NOT NULL, FOREIGN KEY(user_id) REFERENCES users(id));")
-            await db.execute("CREATE TABLE if not exists message_summaries (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INT NOT NULL, summary TEXT, FOREIGN KEY(user_id) REFERENCES users(id));")
-            await db.commit()
-        logger.info("Initialized database.sqlite")
+        await cls.POOL.open()
+        async with cls.POOL.writer() as db:
+            version = await migrate(db)
+        cls.WRITES.start()
+        logger.info(f"Initialized database.sqlite, schema v{version}")
 
     @classmethod
+    def start_maintenance(cls):
+        # Called by one process only, with worker processes it would otherwise run once per worker.
+        if MAINTENANCE_CONFIG["ENABLED"]:
+            cls.MAINTENANCE.start()
+
+    @classmethod
+    async def close(cls):
+        await cls.MAINTENANCE.stop()
+        await cls.WRITES.stop()
+        await cls.POOL.close()
+
+    @classmethod
+    @METRICS.timed("db_query_seconds", op="dml")
     async def execute_dml(cls, sql: str, *parameters: Any):
-        async with aiosqlite.connect(cls.DATABASE_PATH) as db:
-            cursor = await db.cursor()
-            await cursor.execute(sql, parameters)
-            await db.commit()
-            return await cursor.fetchall()
+        async with cls.POOL.writer() as db:
+            async with db.execute(sql, parameters) as cursor:
+                return await cursor.fetchall()
+
+    @classmethod
+    @METRICS.timed("db_query_seconds", op="query")
+    async def execute_query(cls, sql: str, *parameters: Any):
+        async with cls.POOL.reader() as db:
+            async with db.execute(sql, parameters) as cursor:
+                return await cursor.fetchall()
+
+    @classmethod
+    def cache_stats(cls) -> dict[str, dict[str, Any]]:
+        return {"users": cls.KNOWN_USERS.stats(), "summaries": cls.SUMMARIES.stats()}
 
     @classmethod
-    async def insert_user_if_not_exist(cls, telegram_user_id: str, telegram_username: str):
+    async def insert_user_if_not_exist(cls, telegram_user_id: int, telegram_username: str):
+        if cls.KNOWN_USERS.get(telegram_user_id, False):
+            return
         await cls.execute_dml("INSERT OR IGNORE INTO users (tg_id, username) VALUES (?, ?);", telegram_user_id, telegram_username)
+        cls.KNOWN_USERS.set(telegram_user_id, True)
 
     @classmethod
-    async def delete_user(cls, telegram_user_id: str):
+    async def delete_user(cls, telegram_user_id: int):
+        cls.KNOWN_USERS.pop(telegram_user_id)
+        cls.SUMMARIES.pop(telegram_user_id)
+        await cls.WRITES.flush()
         await cls.execute_dml("DELETE FROM users WHERE tg_id=?;", telegram_user_id)
 
+    SAVE_MESSAGE_SQL = "INSERT INTO message_history (user_id, message, role, created_at) VALUES ((SELECT id FROM users WHERE tg_id=?), ?, ?, ?);"
+
+    @classmethod
+    async def flush(cls):
+        await cls.WRITES.flush()
+
     @classmethod
-    async def save_message(cls, telegram_user_id: str, message: str, role: Literal["user", "assistant", "system"]):
-        await cls.execute_dml("INSERT INTO message_history (user_id, message, role) VALUES ((SELECT id FROM users WHERE tg_id=?), ?, ?);", telegram_user_id, message, role)
+    async def save_message(cls, telegram_user_id: int, message: str, role: Literal["user", "assistant", "system"]):
+        cls.WRITES.enqueue(cls.SAVE_MESSAGE_SQL, telegram_user_id, message, role, int(time.time()))
 
     @classmethod
-    async def load_message_history(cls, telegram_user_id: str):
-        res = await cls.execute_dml("SELECT message, role FROM message_history WHERE user_id=(SELECT id FROM users WHERE tg_id=?) ORDER BY id DESC LIMIT 6;", telegram_user_id)
-        return res
+    async def load_message_history(cls, telegram_user_id: int, after_message_id: int = 0, limit: int = 40,
+                                   oldest: bool = False) -> list[tuple[Optional[int], str, str]]:
+        # The newest limit rows after after_message_id, or the oldest with oldest set.
+        # Buffered rows aren't in the query result, a user repeating a message gets both rows.
+        order = "" if oldest else " DESC"
+        rows, res = await cls.WRITES.read_with_pending(cls.SAVE_MESSAGE_SQL, lambda: cls.execute_query(
+            f"SELECT * FROM (SELECT h.id, h.message, h.role FROM users u JOIN message_history h ON h.user_id=u.id WHERE u.tg_id=? AND h.id>? ORDER BY h.id{order} LIMIT ?) ORDER BY id;",
+            telegram_user_id, after_message_id, limit))
+        pending = [(None, message, role) for tg_id, message, role, _ in rows if tg_id == telegram_user_id]
+        return list(res) + pending
 
     @classmethod
-    async def delete_message_history(cls, telegram_user_id: str):
+    async def delete_message_history(cls, telegram_user_id: int):
+        await cls.WRITES.flush()
         await cls.execute_dml("DELETE FROM message_history WHERE user_id=(SELECT id FROM users WHERE tg_id=?)", telegram_user_id)
+        await cls.execute_dml("DELETE FROM message_archive WHERE user_id=(SELECT id FROM users WHERE tg_id=?)", telegram_user_id)
 
     @classmethod
-    async def save_summary(cls, telegram_user_id: str, summary: str):
-        await cls.execute_dml("INSERT INTO message_summaries (user_id, summary) VALUES ((SELECT id FROM users WHERE tg_id=?), ?);", telegram_user_id, summary)
+    async def save_summary(cls, telegram_user_id: int, summary: str, last_message_id: int):
+        cls.SUMMARIES.set(telegram_user_id, (summary, last_message_id))
+        cls.WRITES.enqueue("INSERT INTO message_summaries (user_id, summary, last_message_id) VALUES ((SELECT id FROM users WHERE tg_id=?), ?, ?) ON CONFLICT(user_id) DO UPDATE SET summary=excluded.summary, last_message_id=excluded.last_message_id;",
+                           telegram_user_id, summary, last_message_id, key=("summary", telegram_user_id))
 
     @classmethod
-    async def get_summary(cls, telegram_user_id: str):
-        res = await cls.execute_dml("SELECT summary FROM message_summaries WHERE user_id=(SELECT id FROM users WHERE tg_id=?) ORDER BY id DESC LIMIT 1;", telegram_user_id)
-        return res[0][0] if res else ""
+    async def get_summary(cls, telegram_user_id: int) -> str:
+        return (await cls.get_summary_state(telegram_user_id))[0]
 
     @classmethod
-    async def delete_message_summaries(cls, telegram_user_id: str):
-        await cls.execute_dml("DELETE FROM message_summaries WHERE user_id=(SELECT id FROM users WHERE tg_id=?)", telegram_user_id)
+    async def get_summary_state(cls, telegram_user_id: int) -> tuple[str, int]:
+        if (state := cls.SUMMARIES.get(telegram_user_id)) is not MISSING:
+            return state
+        if pending := cls.WRITES.pending(("summary", telegram_user_id)):
+            return pending[1], pending[2]
+        res = await cls.execute_query("SELECT s.summary, s.last_message_id FROM users u JOIN message_summaries s ON s.user_id=u.id WHERE u.tg_id=?;", telegram_user_id)
+        state = tuple(res[0]) if res else ("", 0)
+        cls.SUMMARIES.add(telegram_user_id, state)
+        return state
+
+    @classmethod
+    async def delete_message_summaries(cls, telegram_user_id: int):
+        # Clearing keeps the history rows but moves the context window past them.
+        cls.WRITES.discard(("summary", telegram_user_id))
+        await cls.WRITES.flush()
+        await cls.execute_dml("INSERT INTO message_summaries (user_id, summary, last_message_id) SELECT u.id, '', (SELECT COALESCE(MAX(h.id), 0) FROM message_history h WHERE h.user_id=u.id) FROM users u WHERE u.tg_id=? ON CONFLICT(user_id) DO UPDATE SET summary=excluded.summary, last_message_id=excluded.last_message_id;", telegram_user_id)
+        cls.SUMMARIES.pop(telegram_user_id)
+
+
+METRICS.gauges_from("db_cache", UserDatabase.cache_stats)
+METRICS.gauges_from("db_write_behind", lambda: {"pending": len(UserDatabase.WRITES)})
+METRICS.gauges_from("db_maintenance", UserDatabase.MAINTENANCE.stats)
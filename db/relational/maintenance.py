@@ -0,0 +1,141 @@
+import json
+import time
+import zlib
+import asyncio
+from itertools import groupby
+from typing import Any, Optional
+
+from log import logger
+from metrics import METRICS
+from .pool import ConnectionPool
+
+# Only history already covered by the user's summary is archived, the bot never reads those rows again.
+# Rows qualify when older than the age limit or when they aren't among the user's newest keep_rows.
+# Users are walked in id windows, a slice only touches the history of its users through the (user_id, id) index
+# and each user's rows in it compress together.
+ARCHIVABLE_SQL = """
+SELECT h.id, h.user_id, h.message, h.role, h.created_at FROM message_summaries s
+JOIN message_history h ON h.user_id=s.user_id AND h.id<=s.last_message_id
+WHERE s.user_id>? AND s.user_id<=? AND (h.created_at<? OR h.id<=(
+    SELECT k.id FROM message_history k WHERE k.user_id=h.user_id ORDER BY k.id DESC LIMIT 1 OFFSET ?))
+ORDER BY h.user_id, h.id;
+"""
+
+PRUNE_SQL = {
+    "summaries": "DELETE FROM message_summaries WHERE user_id NOT IN (SELECT id FROM users);",
+    "history": "DELETE FROM message_history WHERE user_id NOT IN (SELECT id FROM users);",
+    "archive": "DELETE FROM message_archive WHERE user_id NOT IN (SELECT id FROM users);",
+}
+
+
+class Maintenance:
+    # Periodic cleanup of the user database. Every step works in small slices with pauses in between, so the
+    # write-behind queue gets the writer connection back between slices.
+
+    def __init__(self, pool: ConnectionPool, interval: float, first_run_delay: float, max_age_days: float, keep_rows: int,
+                 users_per_slice: int, vacuum_pages: int, pause_ms: float) -> None:
+        self.pool = pool
+        self.interval = interval
+        self.first_run_delay = first_run_delay
+        self.max_age = max_age_days * 86400
+        self.keep_rows = keep_rows
+        self.users_per_slice = users_per_slice
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause_ms / 1000
+        self.last_report: dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="dbMaintenance")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict[str, float]:
+        return self.last_report
+
+    async def run(self) -> dict[str, float]:
+        started = time.perf_counter()
+        report = {"pruned_rows": await self.prune()}
+        report.update(await self.archive())
+        report["reclaimed_bytes"] = await self.vacuum()
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        self.last_report = report
+        METRICS.inc("db_maintenance_rows_total", report["pruned_rows"], action="pruned")
+        METRICS.inc("db_maintenance_rows_total", report["archived_rows"], action="archived")
+        METRICS.inc("db_maintenance_reclaimed_bytes_total", report["reclaimed_bytes"])
+        logger.info(f"Database maintenance done {report}")
+        return report
+
+    async def prune(self) -> int:
+        # Rows of deleted users: delete_user only removes the users row.
+        pruned = 0
+        for sql in PRUNE_SQL.values():
+            async with self.pool.writer() as db:
+                async with db.execute(sql) as cursor:
+                    pruned += cursor.rowcount
+            await asyncio.sleep(self.pause)
+        return pruned
+
+    async def archive(self) -> dict[str, int]:
+        report = {"archived_rows": 0, "archived_raw_bytes": 0, "archived_bytes": 0}
+        cutoff = int(time.time() - self.max_age)
+        async with self.pool.writer() as db:
+            async with db.execute("SELECT COALESCE(MIN(user_id), 1) - 1, COALESCE(MAX(user_id), 0) FROM message_summaries;") as cursor:
+                start, end = await cursor.fetchone()
+        for after in range(start, end, self.users_per_slice):
+            async with self.pool.writer() as db:
+                async with db.execute(ARCHIVABLE_SQL, (after, after + self.users_per_slice, cutoff, self.keep_rows)) as cursor:
+                    rows = await cursor.fetchall()
+                if not rows:
+                    continue
+                archives = await asyncio.to_thread(self.compress, rows)
+                await db.executemany("INSERT INTO message_archive (user_id, first_message_id, last_message_id, rows, raw_bytes, archived_at, data) VALUES (?, ?, ?, ?, ?, ?, ?);", archives)
+                await db.executemany("DELETE FROM message_history WHERE id=?;", [(row[0],) for row in rows])
+            report["archived_rows"] += len(rows)
+            report["archived_raw_bytes"] += sum(archive[4] for archive in archives)
+            report["archived_bytes"] += sum(len(archive[6]) for archive in archives)
+            await asyncio.sleep(self.pause)
+        return report
+
+    async def vacuum(self) -> int:
+        # Returns the bytes given back to the file system, the file shrinks once the WAL is checkpointed.
+        page_size, before = await self.pragma("page_size"), await self.pragma("page_count")
+        for _ in range(-(-await self.pragma("freelist_count") // self.vacuum_pages)):
+            async with self.pool.writer() as db:
+                # A cursor steps the pragma once and frees a single page, executescript runs it to the end.
+                await db.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages});")
+            await asyncio.sleep(self.pause)
+        return (before - await self.pragma("page_count")) * page_size
+
+    async def pragma(self, name: str) -> int:
+        async with self.pool.writer() as db:
+            async with db.execute(f"PRAGMA {name};") as cursor:
+                return (await cursor.fetchone())[0]
+
+    @staticmethod
+    def compress(rows: list[tuple]) -> list[tuple[Any, ...]]:
+        archives = []
+        archived_at = int(time.time())
+        for user_id, group in groupby(rows, key=lambda row: row[1]):
+            messages = [(message_id, message, role, created_at) for message_id, _, message, role, created_at in group]
+            raw = json.dumps(messages, ensure_ascii=False).encode()
+            archives.append((user_id, messages[0][0], messages[-1][0], len(messages), len(raw), archived_at, zlib.compress(raw, 6)))
+        return archives
+
+    async def _loop(self) -> None:
+        await asyncio.sleep(self.first_run_delay)
+        while True:
+            try:
+                await self.run()
+            except Exception as ex:
+                logger.error(f"Database maintenance failed. {ex}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,77 @@
+import aiosqlite
+from typing import Optional
+
+from log import logger
+
+# Each entry upgrades the schema by one version, tracked in PRAGMA user_version.
+# Never edit an applied migration, append a new one instead.
+MIGRATIONS: list[str] = [
+    # v1: initial schema
+    """
+    CREATE TABLE if not exists users (id INTEGER PRIMARY KEY AUTOINCREMENT, tg_id TEXT UNIQUE, username TEXT);
+    CREATE TABLE if not exists message_history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INT NOT NULL, message TEXT NOT NULL, role TEXT NOT NULL, FOREIGN KEY(user_id) REFERENCES users(id));
+    CREATE TABLE if not exists message_summaries (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INT NOT NULL, summary TEXT, FOREIGN KEY(user_id) REFERENCES users(id));
+    """,
+    # v2: INTEGER tg_id, (user_id, id) history index, one upserted summary row per user
+    """
+    CREATE TABLE users_v2 (id INTEGER PRIMARY KEY AUTOINCREMENT, tg_id INTEGER NOT NULL UNIQUE, username TEXT);
+    INSERT INTO users_v2 (id, tg_id, username) SELECT id, CAST(tg_id AS INTEGER), username FROM users;
+    DROP TABLE users;
+    ALTER TABLE users_v2 RENAME TO users;
+
+    CREATE INDEX if not exists message_history_user_id_id ON message_history (user_id, id);
+
+    CREATE TABLE message_summaries_v2 (user_id INTEGER PRIMARY KEY, summary TEXT NOT NULL, FOREIGN KEY(user_id) REFERENCES users(id));
+    INSERT INTO message_summaries_v2 (user_id, summary)
+        SELECT user_id, summary FROM message_summaries
+        WHERE id IN (SELECT MAX(id) FROM message_summaries GROUP BY user_id) AND summary IS NOT NULL;
+    DROP TABLE message_summaries;
+    ALTER TABLE message_summaries_v2 RENAME TO message_summaries;
+    """,
+    # v3: summaries remember the last history row they cover, later rows form the raw context window
+    """
+    ALTER TABLE message_summaries ADD COLUMN last_message_id INTEGER NOT NULL DEFAULT 0;
+    UPDATE message_summaries SET last_message_id=(SELECT COALESCE(MAX(id), 0) FROM message_history WHERE user_id=message_summaries.user_id);
+    """,
+    # v4: history timestamps for retention, compressed archive of summarized history
+    """
+    ALTER TABLE message_history ADD COLUMN created_at INTEGER NOT NULL DEFAULT 0;
+    UPDATE message_history SET created_at=CAST(strftime('%s', 'now') AS INTEGER);
+    CREATE TABLE if not exists message_archive (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, first_message_id INTEGER NOT NULL, last_message_id INTEGER NOT NULL, rows INTEGER NOT NULL, raw_bytes INTEGER NOT NULL, archived_at INTEGER NOT NULL, data BLOB NOT NULL, FOREIGN KEY(user_id) REFERENCES users(id));
+    CREATE INDEX if not exists message_archive_user_id ON message_archive (user_id);
+    """,
+]
+
+INCREMENTAL = 2
+
+
+async def get_version(db: aiosqlite.Connection) -> int:
+    async with db.execute("PRAGMA user_version;") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def migrate(db: aiosqlite.Connection, target: Optional[int] = None) -> int:
+    target = len(MIGRATIONS) if target is None else target
+    version = await get_version(db)
+
+    for number in range(version + 1, target + 1):
+        logger.info(f"Migrating database to schema v{number}")
+        try:
+            await db.executescript(f"BEGIN IMMEDIATE;\n{MIGRATIONS[number - 1]}\nPRAGMA user_version={number};\nCOMMIT;")
+        except Exception:
+            await db.rollback()
+            raise
+
+    if target >= 4:
+        await enable_incremental_vacuum(db)
+    return max(version, target)
+
+
+async def enable_incremental_vacuum(db: aiosqlite.Connection):
+    # auto_vacuum only changes with a full VACUUM, which can't run inside a migration's transaction. Runs once per database.
+    async with db.execute("PRAGMA auto_vacuum;") as cursor:
+        if (await cursor.fetchone())[0] == INCREMENTAL:
+            return
+    logger.info("Switching database to incremental auto_vacuum, running a full VACUUM once")
+    await db.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    await db.execute("VACUUM;")
@@ -0,0 +1,75 @@
+import asyncio
+import aiosqlite
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+
+from log import logger
+
+
+class ConnectionPool:
+    def __init__(self, path: str, readers: int, cached_statements: int, pragmas: dict[str, Any]) -> None:
+        self.path = path
+        self.readers_count = max(1, readers)
+        self.cached_statements = cached_statements
+        self.pragmas = pragmas
+        self._writer: aiosqlite.Connection | None = None
+        self._write_lock: asyncio.Lock | None = None
+        self._readers: asyncio.Queue[aiosqlite.Connection] | None = None
+        self._all_readers: list[aiosqlite.Connection] = []
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def open(self) -> None:
+        if self.is_open:
+            return
+
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._writer = await self._connect()
+        for _ in range(self.readers_count):
+            reader = await self._connect()
+            await reader.execute("PRAGMA query_only=ON;")
+            self._all_readers.append(reader)
+            self._readers.put_nowait(reader)
+
+        logger.info(f"Opened SQLite pool with 1 writer and {self.readers_count} readers")
+
+    async def close(self) -> None:
+        if not self.is_open:
+            return
+
+        async with self._write_lock:
+            await self._writer.commit()
+            await self._writer.close()
+            self._writer = None
+
+        for reader in self._all_readers:
+            await reader.close()
+        self._all_readers.clear()
+        logger.info("Closed SQLite pool")
+
+    async def _connect(self) -> aiosqlite.Connection:
+        connection = await aiosqlite.connect(self.path, cached_statements=self.cached_statements)
+        for pragma, value in self.pragmas.items():
+            await connection.execute(f"PRAGMA {pragma}={value};")
+        return connection
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except Exception:
+                await self._writer.rollback()
+                raise
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        connection = await self._readers.get()
+        try:
+            yield connection
+        finally:
+            self._readers.put_nowait(connection)
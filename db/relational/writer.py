@@ -0,0 +1,128 @@
+import asyncio
+from itertools import groupby
+from typing import Any, Awaitable, Callable, Hashable, Optional, TypeVar
+
+from log import logger
+from metrics import METRICS
+from .pool import ConnectionPool
+
+T = TypeVar("T")
+
+
+class WriteBehindQueue:
+
+    def __init__(self, pool: ConnectionPool, flush_interval_ms: int, max_rows: int) -> None:
+        self.pool = pool
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_rows = max_rows
+        self._rows: list[tuple[str, tuple]] = []
+        self._keyed: dict[Hashable, tuple[str, tuple]] = {}
+        self._inflight: dict[Hashable, tuple[str, tuple]] = {}
+        self._inflight_rows: list[tuple[str, tuple]] = []
+        self._wakeup: asyncio.Event | None = None
+        self._flush_lock: asyncio.Lock | None = None
+        self._task: asyncio.Task | None = None
+        self._taken = 0
+        self._stopping = False
+
+    def __len__(self) -> int:
+        return len(self._rows) + len(self._keyed)
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run(), name="writeBehindQueue")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        logger.info("Write-behind queue flushed and stopped")
+
+    def enqueue(self, sql: str, *parameters: Any, key: Optional[Hashable] = None) -> None:
+        # Keyed writes coalesce: only the latest statement for a key reaches the database.
+        if key is None:
+            self._rows.append((sql, parameters))
+        else:
+            self._keyed[key] = (sql, parameters)
+
+        if self._wakeup is not None and len(self) >= self.max_rows:
+            self._wakeup.set()
+
+    def pending(self, key: Hashable) -> Optional[tuple]:
+        statement = self._keyed.get(key) or self._inflight.get(key)
+        return statement[1] if statement else None
+
+    def pending_rows(self, sql: str) -> list[tuple]:
+        return [parameters for statement, parameters in self._inflight_rows + self._rows if statement == sql]
+
+    async def read_with_pending(self, sql: str, query: Callable[[], Awaitable[T]], attempts: int = 2) -> tuple[list[tuple], T]:
+        # Buffered rows of sql and a query result that can't contain them yet, so the two are simply concatenated.
+        # Optimistic: retried when a flush took rows while the query ran, the last resort holds off flushes meanwhile.
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        for _ in range(attempts):
+            async with self._flush_lock:
+                # Waits out a flush that is writing, no rows are in flight after it.
+                pass
+            taken = self._taken
+            rows = self.pending_rows(sql)
+            result = await query()
+            if self._taken == taken:
+                return rows, result
+        async with self._flush_lock:
+            return self.pending_rows(sql), await query()
+
+    def discard(self, key: Hashable) -> None:
+        self._keyed.pop(key, None)
+
+    async def flush(self) -> int:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            self._taken += 1
+            self._inflight_rows, self._rows = self._rows, []
+            self._inflight, self._keyed = self._keyed, {}
+            statements = self._inflight_rows + list(self._inflight.values())
+            try:
+                if statements:
+                    await self._write(statements)
+            finally:
+                self._inflight, self._inflight_rows = {}, []
+        return len(statements)
+
+    async def _write(self, statements: list[tuple[str, tuple]]) -> None:
+        METRICS.inc("db_flushed_rows_total", len(statements))
+        try:
+            with METRICS.span("db_flush_seconds"):
+                async with self.pool.writer() as db:
+                    for sql, group in groupby(statements, key=lambda statement: statement[0]):
+                        await db.executemany(sql, [parameters for _, parameters in group])
+            logger.debug(f"Flushed {len(statements)} buffered writes")
+        except Exception as ex:
+            logger.error(f"Error flushing write-behind batch, retrying row by row. {ex}")
+            for sql, parameters in statements:
+                try:
+                    async with self.pool.writer() as db:
+                        await db.execute(sql, parameters)
+                except Exception as ex:
+                    logger.error(f"Dropping buffered write {sql!r}. {ex}")
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as ex:
+                logger.error(f"Error in write-behind queue. {ex}")
+        await self.flush()
@@ -1,19 +1,102 @@
 import os
 import dotenv
+import logging
 import openai
 import json
-from typing import Literal
+import time
+import tiktoken
+from typing import AsyncIterator, Callable, Optional, Union
 from langchain.vectorstores import VectorStore
 from langchain.docstore.document import Document
 
-from .db import DB, DocumentExtractor, query_documents
+from .db import retrieve, on_index_changed, index_fingerprint
+from .chunks import Chunk, Mode, render_chunks
+from .cache import AnswerCache
+from .context import ContextBuilder
+from .scheduler import RequestScheduler, Priority
 from log import logger
+from metrics import METRICS
+
+with open("conf.json") as file:
+    logger.debug("Loading llm api config")
+    config = json.load(file)["LLM"]
 
 dotenv.load_dotenv(".env")
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
 
 
 MODEL = "gpt-3.5-turbo"
+ANSWER_CACHE = config["ANSWER_CACHE"]
+CONTEXT_CONFIG = config["CONTEXT"]
+SCHEDULER_CONFIG = config["SCHEDULER"]
+
+ROLE_NAMES = {"user": "Клиент", "assistant": "Чат-бот", "system": "Система"}
+PRIORITY_NAMES = {Priority.ANSWER: "answer", Priority.SUMMARY: "summary"}
+
+
+class ConversationContext:
+    # Recent raw messages go to the prompt as is, they are compacted into the summary only once they exceed the token budget.
+
+    def __init__(self, token_budget: int, keep_messages: int, max_messages: int) -> None:
+        self.token_budget = token_budget
+        self.keep_messages = keep_messages
+        self.max_messages = max_messages
+        self._encoding: Optional[tiktoken.Encoding] = None
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        if self._encoding is None:
+            self._encoding = tiktoken.encoding_for_model(MODEL)
+        return self._encoding
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def window_tokens(self, history: list[tuple]) -> int:
+        return sum(self.count_tokens(message) for *_, message, _ in history)
+
+    def over_budget(self, history: list[tuple]) -> bool:
+        return len(history) > self.keep_messages and self.window_tokens(history) > self.token_budget
+
+    def split(self, history: list[tuple]) -> tuple[list[tuple], list[tuple]]:
+        # Everything but the last keep_messages is compacted in one batch.
+        if not self.over_budget(history):
+            return [], history
+        return history[:-self.keep_messages], history[-self.keep_messages:]
+
+    @staticmethod
+    def render(history: list[tuple]) -> str:
+        return "\n".join(f"{ROLE_NAMES.get(role, role)} - \"{message}\"" for *_, message, role in history)
+
+
+class AnswerStream:
+
+    def __init__(self, documents: list[Chunk], on_success: Optional[Callable[[str], None]] = None) -> None:
+        self.documents = documents
+        self.on_success = on_success
+        self.text = ""
+        self.success = False
+        self.deltas: Optional[AsyncIterator[str]] = None
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self.deltas
+
+    def complete(self, text: str, success: bool):
+        self.text = text
+        self.success = success
+        if success and self.on_success is not None:
+            self.on_success(text)
+
+    @classmethod
+    def from_text(cls, text: str, documents: list[Chunk]) -> "AnswerStream":
+        stream = cls(documents)
+
+        async def deltas():
+            yield text
+            stream.complete(text, True)
+
+        stream.deltas = deltas()
+        return stream
 
 
 class LLM:
@@ -63,7 +146,7 @@ Lastly, should the brief recap of the prior dialogue contain text, there is no r
 
     SUMMARIZATION_PROMPT = """
 Ты - суммаризатор истории сообщений чат-бота и клиента.
-Тебе будут предоставлены: краткое изложение прошлых сообщений и два последних сообщения от клиента и чат-бота в разделе "История" и "Сообщения" соответственно.
+Тебе будут предоставлены: краткое изложение прошлых сообщений и последние сообщения от клиента и чат-бота в разделе "История" и "Сообщения" соответственно.
 Твоя задача составить максимально подробное, но краткое (не больше 400 слов) изложение истории сообщений.
 Отдавай предпочтение описания хода диалога и меньше обращай внимание на факты об автомобилях.
 Не вдавайся в подробности отдельных сообщений, а суммаризируй только то, о чём возможно клиент ещё спросит.
@@ -74,33 +157,70 @@ Lastly, should the brief recap of the prior dialogue contain text, there is no r
 История:
 {summary}
 """
-    LLM = openai.AsyncOpenAI()
-    EXTRACTOR = DocumentExtractor()
+    LLM = openai.AsyncOpenAI(max_retries=0)
+    SCHEDULER = RequestScheduler(SCHEDULER_CONFIG["RPM"], SCHEDULER_CONFIG["TPM"], SCHEDULER_CONFIG["MAX_CONCURRENCY"],
+                                 SCHEDULER_CONFIG["MAX_RETRIES"], SCHEDULER_CONFIG["BASE_DELAY"], SCHEDULER_CONFIG["MAX_DELAY"])
+    ANSWERS = AnswerCache(ANSWER_CACHE["THRESHOLD"], ANSWER_CACHE["TTL"], ANSWER_CACHE["MAX_SIZE"], ANSWER_CACHE["PERSIST_PATH"],
+                          ANSWER_CACHE["PRAGMAS"])
+
+    @classmethod
+    async def create(cls):
+        await cls.ANSWERS.open(index_fingerprint())
+        on_index_changed(cls.ANSWERS.invalidate)
+
+    @classmethod
+    async def close(cls):
+        await cls.ANSWERS.close()
+
+    CONTEXT = ConversationContext(CONTEXT_CONFIG["HISTORY_TOKEN_BUDGET"], CONTEXT_CONFIG["KEEP_MESSAGES"], CONTEXT_CONFIG["MAX_MESSAGES"])
+    DOCUMENTS = ContextBuilder(CONTEXT_CONFIG["DOCUMENTS_TOKEN_BUDGET"], CONTEXT_CONFIG["MIN_CHUNK_TOKENS"], CONTEXT.count_tokens)
 
     @classmethod
-    async def ask(cls, query: str, summary: str) -> tuple[str, list[Document], bool]:
-        documents = await query_documents(query)
+    async def ask(cls, query: str, summary: str, history: Optional[list[tuple]] = None, stream: bool = False) -> Union[tuple[str, list[Chunk], bool], AnswerStream]:
+        history = history or []
+        try:
+            retrieval = await retrieve(query)
+        except Exception as ex:
+            logger.error(f"Error quering document embeddings. {ex}")
+            retrieval = None
+        documents = retrieval.chunks if retrieval else []
 
-        query = f"Вот краткий обзор предыдущего диалога:\n{summary}\n\nТекущий вопрос:\n{query}"
+        recent = cls.CONTEXT.render(history)
+        cacheable = retrieval is not None and ANSWER_CACHE["ENABLED"] and len(summary) + len(recent) <= ANSWER_CACHE["MAX_SUMMARY_LENGTH"]
+        if cacheable and (answer := cls.ANSWERS.lookup(retrieval.embedding, retrieval.chunk_ids)) is not None:
+            logger.debug("Answer cache hit")
+            return AnswerStream.from_text(answer, documents) if stream else (answer, documents, True)
 
+        query = f"Вот краткий обзор предыдущего диалога:\n{summary}\n\nПоследние сообщения:\n{recent}\n\nТекущий вопрос:\n{query}"
+        context = cls.DOCUMENTS.build(documents)
+
+        # The system prompt is never formatted, so the identical prefix lets OpenAI serve it from its prompt cache.
         messages = [
             {"role": "system", "content": cls.PROMPT},
             {"role": "user",
-                "content": f"Документ с информацией для ответа пользователю:\n{cls.extract_documents_data(documents, 'plain')}\n\nВопрос клиента: \n{query}"},
+                "content": f"Документ с информацией для ответа пользователю:\n{cls.extract_documents_data(context, 'plain')}\n\nВопрос клиента: \n{query}"},
             # {"role": "user", "content": f"История сообщений:\n{summary}"},
             # {"role": "user", "content": query},
         ]
 
-        logger.debug(
-            f"Документ с информацией для ответа пользователю: {cls.extract_documents_data(documents, 'dashed')}\n\nВопрос клиента: \n{query}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Документ с информацией для ответа пользователю: {cls.extract_documents_data(context, 'dashed')}\n\nВопрос клиента: \n{query}")
+
+        if stream:
+            on_success = (lambda answer: cls.ANSWERS.store(retrieval.embedding, retrieval.chunk_ids, answer)) if cacheable else None
+            answer_stream = AnswerStream(documents, on_success)
+            answer_stream.deltas = cls.__stream_request(messages, answer_stream)
+            return answer_stream
 
-        answer, success = await cls.__make_request(messages)
+        answer, success = await cls.__make_request(messages, Priority.ANSWER)
+        if cacheable and success:
+            cls.ANSWERS.store(retrieval.embedding, retrieval.chunk_ids, answer)
         return answer, documents, success
 
     @classmethod
-    def extract_documents_data(cls, documents: list[Document], mode: Literal["plain", "quotes", "dashed", "xml", "json"]):
-        func = getattr(cls.EXTRACTOR, f"extract_{mode}")
-        return func(documents)
+    def extract_documents_data(cls, documents: list[Chunk], mode: Mode) -> str:
+        return render_chunks(documents, mode)
 
     @classmethod
     def documents_to_str(cls, documents: list[Document]):
@@ -115,28 +235,82 @@ Lastly, should the brief recap of the prior dialogue contain text, there is no r
         return res
 
     @classmethod
-    async def summarize_history(cls, summary: str, user_message: str, bot_message: str) -> tuple[str, bool]:
+    async def summarize_history(cls, summary: str, history: list[tuple]) -> tuple[str, bool]:
         prompt = cls.SUMMARIZATION_PROMPT.format(summary=summary)
         messages = [
             {"role": "system", "content": prompt},
-            {"role": "user", "content": f"Сообщения:\nКлиент - \"{user_message}\"\nЧат-бот - \"{bot_message}\""},
+            {"role": "user", "content": f"Сообщения:\n{cls.CONTEXT.render(history)}"},
         ]
 
-        answer, success = await cls.__make_request(messages)
+        answer, success = await cls.__make_request(messages, Priority.SUMMARY)
         return answer, success
 
     @classmethod
-    async def __make_request(cls, messages: list[dict]) -> tuple[str, bool]:
+    def estimate_tokens(cls, messages: list[dict]) -> int:
+        return sum(cls.CONTEXT.count_tokens(message["content"]) + 4 for message in messages) + SCHEDULER_CONFIG["EXPECTED_COMPLETION_TOKENS"]
+
+    @classmethod
+    async def __make_request(cls, messages: list[dict], priority: int) -> tuple[str, bool]:
         success = False
+        kind = PRIORITY_NAMES[priority]
         try:
-            responce = await cls.LLM.chat.completions.create(model=MODEL, messages=messages)
+            tokens = cls.estimate_tokens(messages)
+            with METRICS.span("llm_request_seconds", kind=kind):
+                responce = await cls.SCHEDULER.run(priority, tokens, lambda: cls.LLM.chat.completions.create(model=MODEL, messages=messages))
+            if responce.usage is not None:
+                cls.SCHEDULER.settle(tokens, responce.usage.total_tokens)
+                METRICS.inc("llm_tokens_total", responce.usage.prompt_tokens, kind=kind, type="prompt")
+                METRICS.inc("llm_tokens_total", responce.usage.completion_tokens, kind=kind, type="completion")
             answer = responce.choices[0].message.content
             success = True
-        except openai.BadRequestError as error:
+        except Exception as ex:
+            answer = cls.__error_answer(ex)
+
+        METRICS.inc("llm_requests_total", kind=kind, status="ok" if success else "error")
+        return answer, success
+
+    @classmethod
+    async def __stream_request(cls, messages: list[dict], stream: AnswerStream) -> AsyncIterator[str]:
+        answer = ""
+        started = time.perf_counter()
+        responce = None
+        try:
+            tokens = cls.estimate_tokens(messages)
+            # Only opening the stream is retried, once deltas reached the user a failure is final. The scheduler slot
+            # is released once the stream is open, reading it waits on the user's Telegram send queue.
+            responce = await cls.SCHEDULER.run(
+                Priority.ANSWER, tokens, lambda: cls.LLM.chat.completions.create(model=MODEL, messages=messages, stream=True))
+            async for chunk in responce:
+                if chunk.choices and (delta := chunk.choices[0].delta.content):
+                    if not answer:
+                        METRICS.observe("llm_first_token_seconds", time.perf_counter() - started)
+                    answer += delta
+                    stream.text = answer
+                    yield delta
+        except Exception as ex:
+            stream.complete(cls.__error_answer(ex), False)
+        else:
+            stream.complete(answer, True)
+        if responce is not None:
+            # Streamed responses carry no usage, the tokens are counted the same way as the estimate.
+            prompt = tokens - SCHEDULER_CONFIG["EXPECTED_COMPLETION_TOKENS"]
+            completion = cls.CONTEXT.count_tokens(answer)
+            cls.SCHEDULER.settle(tokens, prompt + completion)
+            METRICS.inc("llm_tokens_total", prompt, kind="answer_stream", type="prompt")
+            METRICS.inc("llm_tokens_total", completion, kind="answer_stream", type="completion")
+        METRICS.observe("llm_request_seconds", time.perf_counter() - started, kind="answer_stream")
+        METRICS.inc("llm_requests_total", kind="answer_stream", status="ok" if stream.success else "error")
+
+    @staticmethod
+    def __error_answer(error: Exception) -> str:
+        if isinstance(error, openai.BadRequestError):
             answer = json.loads(error.response._content)["error"]["message"]
             logger.error("Openai BadRequestError. " + answer)
-        except Exception as ex:
+        else:
             answer = "Просим прощения, но возникла неизвестная ошибка. Попробуйте повторить запрос позже."
-            logger.error(f"Error in request to OpenAI API. {ex}")
+            logger.error(f"Error in request to OpenAI API. {error}")
+        return answer
 
-        return answer, success
+
+METRICS.gauges_from("answer_cache", LLM.ANSWERS.stats)
+METRICS.gauges_from("scheduler", LLM.SCHEDULER.stats)
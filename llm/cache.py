@@ -0,0 +1,148 @@
+import json
+import time
+import asyncio
+import aiosqlite
+import numpy as np
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from log import logger
+
+
+@dataclass
+class CachedAnswer:
+    slot: int
+    chunk_ids: tuple[str, ...]
+    answer: str
+    created: float
+
+
+class AnswerCache:
+
+    def __init__(self, threshold: float, ttl: float, max_size: int, persist_path: Optional[str] = None,
+                 pragmas: Optional[dict[str, Any]] = None) -> None:
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.persist_path = persist_path
+        self.pragmas = pragmas or {}
+        self.fingerprint = ""
+        self.hits = 0
+        self.misses = 0
+        self._vectors: Optional[np.ndarray] = None
+        self._valid = np.zeros(max_size, dtype=bool)
+        self._entries: OrderedDict[int, CachedAnswer] = OrderedDict()
+        self._db: Optional[aiosqlite.Connection] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, embedding: np.ndarray, chunk_ids: tuple[str, ...]) -> Optional[str]:
+        if self._entries:
+            similarities = self._vectors @ self._normalize(embedding)
+            similarities[~self._valid] = -1.0
+            now = time.time()
+            candidates = np.flatnonzero(similarities >= self.threshold)
+            for slot in map(int, candidates[np.argsort(-similarities[candidates])]):
+                entry = self._entries[slot]
+                if now - entry.created > self.ttl:
+                    self._evict(slot)
+                    continue
+                if set(entry.chunk_ids) == set(chunk_ids):
+                    self._entries.move_to_end(slot)
+                    self.hits += 1
+                    return entry.answer
+
+        self.misses += 1
+        return None
+
+    def store(self, embedding: np.ndarray, chunk_ids: tuple[str, ...], answer: str, created: Optional[float] = None) -> None:
+        embedding = self._normalize(embedding)
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_size, embedding.shape[0]), dtype=np.float32)
+
+        if len(self._entries) >= self.max_size:
+            self._evict(next(iter(self._entries)))
+        slot = int(np.flatnonzero(~self._valid)[0])
+
+        self._vectors[slot] = embedding
+        self._valid[slot] = True
+        self._entries[slot] = CachedAnswer(slot, tuple(chunk_ids), answer, created or time.time())
+
+        if self._db is not None and created is None:
+            self._spawn(self._persist(embedding, chunk_ids, answer))
+
+    def invalidate(self, fingerprint: str) -> None:
+        if fingerprint == self.fingerprint:
+            return
+        logger.info(f"Knowledge index changed, dropping {len(self._entries)} cached answers")
+        self.fingerprint = fingerprint
+        self._entries.clear()
+        self._valid[:] = False
+        if self._db is not None:
+            self._spawn(self._db_execute("DELETE FROM answer_cache WHERE fingerprint != ?;", fingerprint))
+
+    def stats(self) -> dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    async def open(self, fingerprint: str) -> None:
+        self.fingerprint = fingerprint
+        if not self.persist_path:
+            return
+
+        self._db = await aiosqlite.connect(self.persist_path)
+        # Worker processes share the file, WAL and busy_timeout let their inserts wait for each other instead of failing.
+        for pragma, value in self.pragmas.items():
+            await self._db.execute(f"PRAGMA {pragma}={value};")
+        await self._db.execute("CREATE TABLE if not exists answer_cache (id INTEGER PRIMARY KEY AUTOINCREMENT, fingerprint TEXT NOT NULL, chunk_ids TEXT NOT NULL, embedding BLOB NOT NULL, answer TEXT NOT NULL, created REAL NOT NULL);")
+        await self._db.execute("DELETE FROM answer_cache WHERE fingerprint != ? OR created < ?;", (fingerprint, time.time() - self.ttl))
+        await self._db.execute("DELETE FROM answer_cache WHERE id NOT IN (SELECT id FROM answer_cache ORDER BY id DESC LIMIT ?);", (self.max_size,))
+        await self._db.commit()
+
+        async with self._db.execute("SELECT chunk_ids, embedding, answer, created FROM answer_cache ORDER BY id DESC LIMIT ?;", (self.max_size,)) as cursor:
+            rows = await cursor.fetchall()
+        for chunk_ids, embedding, answer, created in reversed(rows):
+            self.store(np.frombuffer(embedding, dtype=np.float32), tuple(json.loads(chunk_ids)), answer, created)
+        logger.info(f"Loaded {len(rows)} cached answers")
+
+    async def close(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    def _evict(self, slot: int) -> None:
+        self._entries.pop(slot, None)
+        self._valid[slot] = False
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _spawn(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _persist(self, embedding: np.ndarray, chunk_ids: tuple[str, ...], answer: str) -> None:
+        await self._db_execute("INSERT INTO answer_cache (fingerprint, chunk_ids, embedding, answer, created) VALUES (?, ?, ?, ?, ?);",
+                               self.fingerprint, json.dumps(list(chunk_ids)), embedding.tobytes(), answer, time.time())
+
+    async def _db_execute(self, sql: str, *parameters: Any) -> None:
+        try:
+            await self._db.execute(sql, parameters)
+            await self._db.commit()
+        except Exception as ex:
+            logger.error(f"Error persisting answer cache. {ex}")
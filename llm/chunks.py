@@ -0,0 +1,117 @@
+import os
+import mmap
+import tiktoken
+import numpy as np
+from dataclasses import dataclass
+from typing import Literal, Optional
+from langchain.docstore.document import Document
+
+# Token counts are stored with the index, so this has to stay the encoding of llm.api.MODEL.
+ENCODING = "cl100k_base"
+FIELDS = ("text", "header_1", "header_2", "plain", "xml", "dashed")
+FIELD_INDEX = {field: i for i, field in enumerate(FIELDS)}
+
+Mode = Literal["plain", "xml", "dashed"]
+
+_encoding: Optional[tiktoken.Encoding] = None
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding(ENCODING)
+    return len(_encoding.encode(text))
+
+
+def render(mode: Mode, text: str, header_1: str, header_2: str) -> str:
+    if mode == "plain":
+        return f"Контент:\n{header_2}\n{text}\nНазвание:{header_1 or 'Kia'}\n\n"
+    if mode == "xml":
+        return f"<content>\n{header_2}\n{text}\n</content>\n<source>\n{header_1 or 'Kia'}\n</source>\n"
+    if mode == "dashed":
+        return f"=====================\n{text}\n"
+    raise ValueError(f"Unknown render mode {mode!r}")
+
+
+def render_chunks(chunks: list["Chunk"], mode: Mode) -> str:
+    # Fragments carry everything but the per-prompt parts: the xml wrapper and the dashed numbering.
+    if mode == "xml":
+        return "<document>\n" + "".join(chunk.render(mode) for chunk in chunks) + "</document>\n\n"
+    if mode == "dashed":
+        return "".join(f"\n=====================Отрывок документа №{i}{chunk.render(mode)}" for i, chunk in enumerate(chunks, 1))
+    return "".join(chunk.render(mode) for chunk in chunks)
+
+
+@dataclass
+class Chunk:
+    text: str
+    header_1: str
+    header_2: str
+    tokens: int
+    store: Optional["ChunkStore"] = None
+    row: int = -1
+
+    @property
+    def section(self) -> tuple[str, str]:
+        return self.header_1, self.header_2
+
+    def render(self, mode: Mode) -> str:
+        if self.store is not None:
+            return self.store.field(self.row, mode)
+        return render(mode, self.text, self.header_1, self.header_2)
+
+    def with_text(self, text: str, tokens: int) -> "Chunk":
+        # Trimmed or truncated text no longer matches the stored fragments, it is rendered on demand.
+        return Chunk(text, self.header_1, self.header_2, tokens)
+
+
+class ChunkStore:
+    # Chunk texts, headers and rendered fragments in one UTF-8 blob, addressed by FAISS row id through an offsets array.
+    # Stored next to index.faiss and memory-mapped, so worker processes share the page cache like they do the index.
+
+    def __init__(self, data: bytes, offsets: np.ndarray, tokens: np.ndarray) -> None:
+        self.data = data
+        self.offsets = offsets
+        self.tokens = tokens
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    @classmethod
+    def from_documents(cls, documents: list[Document]) -> "ChunkStore":
+        parts: list[bytes] = []
+        tokens = np.empty(len(documents), dtype=np.int32)
+        for row, document in enumerate(documents):
+            text = document.page_content.strip()
+            header_1, header_2 = document.metadata.get("Header 1", ""), document.metadata.get("Header 2", "")
+            values = (text, header_1, header_2, *(render(mode, text, header_1, header_2) for mode in FIELDS[3:]))
+            parts.extend(value.encode() for value in values)
+            tokens[row] = count_tokens(text)
+        offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum([len(part) for part in parts], out=offsets[1:])
+        return cls(b"".join(parts), offsets, tokens)
+
+    @classmethod
+    def open(cls, directory: str) -> Optional["ChunkStore"]:
+        if not os.path.exists(path := f"{directory}/chunks.bin"):
+            return None
+        with open(path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+        return cls(data, np.load(f"{directory}/chunks.offsets.npy", mmap_mode="r"), np.load(f"{directory}/chunks.tokens.npy", mmap_mode="r"))
+
+    def write(self, directory: str) -> None:
+        # Each file is swapped in whole, chunks.bin last since open() goes by it, so readers never map a partial store.
+        for name, content in (("chunks.offsets.npy", self.offsets), ("chunks.tokens.npy", self.tokens), ("chunks.bin", self.data)):
+            with open(tmp := f"{directory}/{name}.{os.getpid()}.tmp", "wb") as file:
+                if isinstance(content, np.ndarray):
+                    np.save(file, content)
+                else:
+                    file.write(content)
+            os.replace(tmp, f"{directory}/{name}")
+
+    def field(self, row: int, field: str) -> str:
+        i = row * len(FIELDS) + FIELD_INDEX[field]
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode()
+
+    def chunk(self, row: int) -> Chunk:
+        return Chunk(self.field(row, "text"), self.field(row, "header_1"), self.field(row, "header_2"), int(self.tokens[row]), self, row)
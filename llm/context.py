@@ -0,0 +1,74 @@
+import re
+from typing import Callable
+
+from .chunks import Chunk
+
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+MIN_OVERLAP = 16
+
+
+def overlap(first: str, second: str, max_chars: int = 2000) -> int:
+    # Length of the longest suffix of first that is a prefix of second, as left by TokenTextSplitter's chunk overlap.
+    for size in range(min(len(first), len(second), max_chars), MIN_OVERLAP - 1, -1):
+        if first[-size:] == second[:size]:
+            return size
+    return 0
+
+
+class ContextBuilder:
+
+    def __init__(self, token_budget: int, min_chunk_tokens: int, count_tokens: Callable[[str], int]) -> None:
+        self.token_budget = token_budget
+        self.min_chunk_tokens = min_chunk_tokens
+        self.count_tokens = count_tokens
+
+    def build(self, chunks: list[Chunk]) -> list[Chunk]:
+        return self.fit(self.deduplicate(chunks))
+
+    def deduplicate(self, chunks: list[Chunk]) -> list[Chunk]:
+        # Untouched chunks are kept as they are, with their stored token counts and fragments.
+        result: list[Chunk] = []
+        for chunk in chunks:
+            content = chunk.text.strip()
+            for kept in result:
+                if kept.section != chunk.section:
+                    continue
+                if content in kept.text:
+                    break
+                if shared := overlap(kept.text, content):
+                    content = content[shared:].lstrip()
+                if shared := overlap(content, kept.text):
+                    content = content[:-shared].rstrip()
+            else:
+                if content == chunk.text:
+                    result.append(chunk)
+                elif content:
+                    result.append(chunk.with_text(content, self.count_tokens(content)))
+        return result
+
+    def fit(self, chunks: list[Chunk]) -> list[Chunk]:
+        # Chunks come in relevance order, the first one that doesn't fit is cut at a sentence boundary and the rest are dropped.
+        result: list[Chunk] = []
+        remaining = self.token_budget
+        for chunk in chunks:
+            if chunk.tokens <= remaining:
+                result.append(chunk)
+                remaining -= chunk.tokens
+                continue
+            if remaining >= self.min_chunk_tokens and (content := self.truncate(chunk.text, remaining)):
+                result.append(chunk.with_text(content, self.count_tokens(content)))
+            break
+        return result
+
+    def truncate(self, text: str, budget: int) -> str:
+        # Token counts only grow with the prefix, so the longest sentence prefix within budget is found by binary
+        # search over the sentence ends: log2(sentences) counts instead of one per sentence.
+        ends = [match.start() for match in SENTENCE_END.finditer(text + "\n")]
+        low, high = 0, len(ends)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(text[:ends[middle - 1]]) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:ends[low - 1]].rstrip() if low else ""
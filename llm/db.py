@@ -1,14 +1,25 @@
 import os
 import sys
 import json
+import re
+import time
+import pickle
+import shutil
+import asyncio
+import hashlib
 import dotenv
-from typing import Literal
+import faiss
+import numpy as np
+from dataclasses import dataclass
+from typing import Callable, Optional
 from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.docstore.document import Document
 from langchain.text_splitter import MarkdownHeaderTextSplitter, TokenTextSplitter
-from langchain.vectorstores.faiss import FAISS
 
 from log import logger
+from metrics import METRICS
+from .chunks import Chunk, ChunkStore
+from .embeddings import CachedEmbeddings
 
 with open("conf.json") as file:
     logger.debug("Loadin llm db config")
@@ -23,11 +34,83 @@ FILES = config["FILES"]
 CHUNK_SIZE = config["CHUNK_SIZE"]
 CHUNK_OVERLAP = config["CHUNK_OVERLAP"]
 DOCUMENTS_PER_QUERY = config["DOCUMENTS_PER_QUERY"]
+EMBEDDING_CACHE = config["EMBEDDING_CACHE"]
+REBUILD = config["REBUILD"]
+INDEX = config["INDEX"]
+RETRIEVAL_BATCH = config["RETRIEVAL_BATCH"]
 
-EMBEDDINGS = OpenAIEmbeddings()
+# Flat codes are memory-mapped where faiss supports it, so bot processes share one page-cached copy of the vectors.
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
 
+_index_listeners: list[Callable[[str], None]] = []
 
-def load_documents():
+
+@dataclass(frozen=True)
+class LoadedIndex:
+    # One index version, replaced as a whole so a search never pairs an index with another version's rows.
+    directory: str
+    index: faiss.Index
+    chunk_ids: list[str]
+    chunks: ChunkStore
+
+
+@dataclass
+class Retrieval:
+    embedding: np.ndarray
+    chunk_ids: tuple[str, ...]
+    chunks: list[Chunk]
+
+
+def get_embeddings() -> CachedEmbeddings:
+    global _embeddings
+    if _embeddings is None:
+        openai_embeddings = OpenAIEmbeddings()
+        _embeddings = CachedEmbeddings(openai_embeddings, openai_embeddings.model, EMBEDDING_CACHE["MAX_SIZE"],
+                                       EMBEDDING_CACHE["DISK_DIR"], EMBEDDING_CACHE["STATS_EVERY"])
+    return _embeddings
+
+
+def index_ready() -> asyncio.Event:
+    global _ready
+    if _ready is None:
+        _ready = asyncio.Event()
+    return _ready
+
+
+async def wait_index_ready(timeout: float) -> bool:
+    try:
+        await asyncio.wait_for(index_ready().wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def on_index_changed(callback: Callable[[str], None]):
+    _index_listeners.append(callback)
+
+
+def current_index_dir() -> str:
+    # CURRENT names the live index version, it is replaced atomically after a rebuild.
+    if os.path.exists(pointer := f"{EMBEDDINGS_DIR}/CURRENT"):
+        with open(pointer) as file:
+            return f"{EMBEDDINGS_DIR}/{file.read().strip()}"
+    return EMBEDDINGS_DIR
+
+
+def index_fingerprint() -> str:
+    if not os.path.exists(path := f"{current_index_dir()}/index.faiss"):
+        return ""
+    stat = os.stat(path)
+    return hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+
+
+def notify_index_changed():
+    fingerprint = index_fingerprint()
+    for callback in _index_listeners:
+        callback(fingerprint)
+
+
+def split_documents() -> list[Document]:
     splitter = MarkdownHeaderTextSplitter(
         [("##", "Header 1"), ("###", "Header 2")])
     docs: list[Document] = []
@@ -38,54 +121,288 @@ def load_documents():
     token_splitter = TokenTextSplitter(
         chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
 
-    docs = token_splitter.split_documents(docs)
-    db = FAISS.from_documents(docs, EMBEDDINGS)
-    db.save_local(EMBEDDINGS_DIR)
-    return db
+    return token_splitter.split_documents(docs)
+
+
+def chunk_hash(document: Document) -> str:
+    content = json.dumps([document.metadata, document.page_content], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def read_manifest(directory: str) -> tuple[list[str], Optional[np.ndarray], str]:
+    if not os.path.exists(f"{directory}/manifest.json"):
+        return [], None, ""
+    with open(f"{directory}/manifest.json") as file:
+        manifest = json.load(file)
+    return manifest["chunks"], np.load(f"{directory}/vectors.npy"), manifest.get("index", "flat")
+
+
+async def embed_in_batches(texts: list[str]) -> list[np.ndarray]:
+    semaphore = asyncio.Semaphore(REBUILD["CONCURRENCY"])
+
+    async def embed(batch: list[str]) -> list[list[float]]:
+        async with semaphore:
+            return await get_embeddings().aembed_documents(batch)
+
+    size = REBUILD["BATCH_SIZE"]
+    batches = await asyncio.gather(*(embed(texts[i:i + size]) for i in range(0, len(texts), size)))
+    return [np.asarray(vector, dtype=np.float32) for batch in batches for vector in batch]
+
+
+def index_factory_string(index_type: str, count: int, dim: int) -> str:
+    # IVF needs ~39 training points per list and PQ 2^bits per sub-quantizer, small corpora fall back to what they can train.
+    nlist = INDEX["NLIST"] or int(4 * count ** 0.5)
+    nlist = max(1, min(nlist, count // 39))
+    if index_type == "ivf_pq" and count < 2 ** INDEX["PQ_BITS"] * 39:
+        logger.warning(f"{count} chunks are too few to train IVF-PQ, using IVF-Flat")
+        index_type = "ivf_flat"
+
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    if index_type == "ivf_pq":
+        m = max(m for m in range(1, INDEX["PQ_M"] + 1) if dim % m == 0)
+        return f"IVF{nlist},PQ{m}x{INDEX['PQ_BITS']}"
+    if index_type == "hnsw":
+        return f"HNSW{INDEX['HNSW_M']},Flat"
+    raise ValueError(f"Unknown FAISS index type {index_type!r}")
+
+
+def create_index(vectors: np.ndarray, index_type: str = INDEX["TYPE"]) -> faiss.Index:
+    count, dim = vectors.shape
+    index = faiss.index_factory(dim, index_factory_string(index_type, count, dim), faiss.METRIC_L2)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efConstruction = INDEX["EF_CONSTRUCTION"]
+        index.hnsw.efSearch = INDEX["EF_SEARCH"]
+    if not index.is_trained:
+        index.train(vectors)
+    if (ivf := faiss.try_extract_index_ivf(index)) is not None:
+        ivf.nprobe = INDEX["NPROBE"]
+    index.add(vectors)
+    return index
+
+
+def write_index(documents: list[Document], hashes: list[str], vectors: np.ndarray) -> str:
+    version = f"v{time.time_ns()}"
+    directory = f"{EMBEDDINGS_DIR}/{version}"
+    os.makedirs(directory)
+    faiss.write_index(create_index(vectors), f"{directory}/index.faiss")
+    ChunkStore.from_documents(documents).write(directory)
+    write_manifest(directory, hashes, vectors, INDEX["TYPE"])
+
+    with open(f"{EMBEDDINGS_DIR}/CURRENT.tmp", "w") as file:
+        file.write(version)
+    os.replace(f"{EMBEDDINGS_DIR}/CURRENT.tmp", f"{EMBEDDINGS_DIR}/CURRENT")
+    return directory
+
+
+def write_manifest(directory: str, hashes: list[str], vectors: np.ndarray, index_type: str):
+    np.save(f"{directory}/vectors.npy", vectors)
+    with open(f"{directory}/manifest.json.tmp", "w") as file:
+        json.dump({"chunks": hashes, "index": index_type}, file)
+    os.replace(f"{directory}/manifest.json.tmp", f"{directory}/manifest.json")
 
 
-if os.path.exists(some_path := f"{EMBEDDINGS_DIR}/index.faiss"):
-    DB = FAISS.load_local(EMBEDDINGS_DIR, EMBEDDINGS)
-    logger.debug("Loading existing embeddings")
-else:
-    DB = load_documents()
-    logger.debug("Creating new embeddings")
+def load_index(directory: str) -> LoadedIndex:
+    try:
+        index = faiss.read_index(f"{directory}/index.faiss", MMAP_FLAGS)
+    except RuntimeError as ex:
+        logger.debug(f"Memory-mapped FAISS read is not supported, loading into memory. {ex}")
+        index = faiss.read_index(f"{directory}/index.faiss")
+    if not os.path.exists(f"{directory}/manifest.json") or (chunks := ChunkStore.open(directory)) is None:
+        convert_legacy_index(directory, index)
+        chunks = ChunkStore.open(directory)
+    with open(f"{directory}/manifest.json") as file:
+        chunk_ids = json.load(file)["chunks"]
+    return LoadedIndex(directory, index, chunk_ids, chunks)
+
+
+def convert_legacy_index(directory: str, index: faiss.Index):
+    # Versions saved by langchain's FAISS keep their chunks in a pickled docstore. It is unpickled once here and
+    # written out as a chunk store, plus a manifest for versions that predate it, so later loads skip it.
+    logger.info(f"Converting the langchain docstore in {directory} to a chunk store")
+    with open(f"{directory}/index.pkl", "rb") as file:
+        docstore, index_to_docstore_id = pickle.load(file)
+    chunk_ids = [index_to_docstore_id[row] for row in range(index.ntotal)]
+    ChunkStore.from_documents([docstore.search(chunk_id) for chunk_id in chunk_ids]).write(directory)
+    if not os.path.exists(f"{directory}/manifest.json"):
+        write_manifest(directory, chunk_ids, index.reconstruct_n(0, index.ntotal), "flat")
+
+
+def remove_stale_versions(keep: int = 2):
+    versions = sorted(name for name in os.listdir(EMBEDDINGS_DIR) if re.fullmatch(r"v\d+", name))
+    for name in versions[:-keep]:
+        shutil.rmtree(f"{EMBEDDINGS_DIR}/{name}", ignore_errors=True)
+
+
+async def rebuild_index(force: bool = False) -> dict[str, int]:
+    global _rebuild_lock
+    if _rebuild_lock is None:
+        _rebuild_lock = asyncio.Lock()
+    async with _rebuild_lock:
+        return await _rebuild(force)
+
+
+async def _rebuild(force: bool) -> dict[str, int]:
+    global LOADED
+    documents, hashes, hashes_seen = [], [], set()
+    for document in split_documents():
+        if (digest := chunk_hash(document)) not in hashes_seen:
+            documents.append(document)
+            hashes.append(digest)
+            hashes_seen.add(digest)
+
+    old_hashes, old_vectors, old_index_type = read_manifest(current_index_dir())
+    old_rows = {digest: row for row, digest in enumerate(old_hashes)}
+    changed = [i for i, digest in enumerate(hashes) if force or digest not in old_rows]
+    stats = {"chunks": len(hashes), "embedded": len(changed), "removed": len(old_rows.keys() - hashes_seen)}
+    # A different INDEX.TYPE only rebuilds the index from the stored vectors, nothing is re-embedded.
+    if not changed and not stats["removed"] and old_hashes and old_index_type == INDEX["TYPE"]:
+        logger.info(f"FAISS index is up to date {stats}")
+        return stats
+
+    embedded = dict(zip(changed, await embed_in_batches([documents[i].page_content for i in changed])))
+    vectors = np.stack([embedded[i] if i in embedded else old_vectors[old_rows[digest]]
+                        for i, digest in enumerate(hashes)])
+
+    directory = await asyncio.to_thread(write_index, documents, hashes, vectors)
+    LOADED = await asyncio.to_thread(load_index, directory)
+    remove_stale_versions()
+    notify_index_changed()
+    logger.info(f"Rebuilt FAISS index {stats}")
+    return stats
+
+
+async def reload_index() -> bool:
+    global LOADED
+    directory = current_index_dir()
+    if LOADED is not None and directory == LOADED.directory:
+        return False
+    LOADED = await asyncio.to_thread(load_index, directory)
+    notify_index_changed()
+    logger.info(f"Reloaded FAISS index from {directory}")
+    return True
+
+
+async def watch_index():
+    while True:
+        await asyncio.sleep(REBUILD["WATCH_INTERVAL"])
+        try:
+            await reload_index()
+        except Exception as ex:
+            logger.error(f"Error reloading FAISS index. {ex}")
+
+
+async def warm_up():
+    # Runs next to polling, handlers wait on index_ready() instead of the import blocking startup.
+    started = time.perf_counter()
+    try:
+        if os.path.exists(f"{current_index_dir()}/index.faiss"):
+            await reload_index()
+        else:
+            logger.info("No FAISS index found, building a new one")
+            await rebuild_index(force=True)
+        # One search faults the mapped vectors in before the first user query does.
+        await asyncio.to_thread(search_by_vector, np.zeros(LOADED.index.d, dtype=np.float32))
+        logger.info(f"Loaded FAISS from {LOADED.directory} in {time.perf_counter() - started:.2f}s")
+    except Exception as ex:
+        logger.error(f"Error loading FAISS index. {ex}")
+    finally:
+        index_ready().set()
+
+
+_embeddings: Optional[CachedEmbeddings] = None
+_rebuild_lock: Optional[asyncio.Lock] = None
+_ready: Optional[asyncio.Event] = None
+LOADED: Optional[LoadedIndex] = None
+
+
+def search_by_vectors(embeddings: np.ndarray, k: int = DOCUMENTS_PER_QUERY) -> list[tuple[tuple[str, ...], list[Chunk]]]:
+    loaded = LOADED
+    if loaded is None:
+        raise RuntimeError("FAISS index is not loaded")
+    _, indices = loaded.index.search(embeddings, k)
+    results = []
+    for row in indices:
+        rows = [int(i) for i in row if i != -1]
+        results.append((tuple(loaded.chunk_ids[i] for i in rows), [loaded.chunks.chunk(i) for i in rows]))
+    return results
+
+
+def search_by_vector(embedding: np.ndarray, k: int = DOCUMENTS_PER_QUERY) -> tuple[tuple[str, ...], list[Chunk]]:
+    return search_by_vectors(embedding.reshape(1, -1), k)[0]
+
+
+class RetrievalBatcher:
+    # Queries arriving within the window share one embeddings request and one matrix search.
+
+    def __init__(self, max_size: int, window_ms: float, k: int) -> None:
+        self.max_size = max_size
+        self.window = window_ms / 1000
+        self.k = k
+        self.batches = 0
+        self.queries = 0
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
 
-logger.info("Loaded FAISS")
+    async def retrieve(self, text: str) -> Retrieval:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def stats(self) -> dict[str, float]:
+        return {"batches": self.batches, "queries": self.queries, "mean_batch": self.queries / self.batches if self.batches else 0.0}
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[str, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.queries += len(batch)
+        try:
+            with METRICS.span("embedding_seconds"):
+                embeddings = np.asarray(await get_embeddings().aembed_documents([text for text, _ in batch]), dtype=np.float32)
+            with METRICS.span("faiss_search_seconds"):
+                results = await asyncio.to_thread(search_by_vectors, embeddings, self.k)
+        except Exception as ex:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+
+        for (_, future), embedding, (chunk_ids, chunks) in zip(batch, embeddings, results):
+            if not future.done():
+                future.set_result(Retrieval(embedding, chunk_ids, chunks))
+
+
+RETRIEVAL = RetrievalBatcher(RETRIEVAL_BATCH["MAX_SIZE"], RETRIEVAL_BATCH["WINDOW_MS"], DOCUMENTS_PER_QUERY)
+METRICS.gauges_from("retrieval", RETRIEVAL.stats)
+METRICS.gauges_from("embedding_cache", lambda: _embeddings.stats() if _embeddings is not None else {})
+
+
+@METRICS.timed("retrieval_seconds")
+async def retrieve(text: str) -> Retrieval:
+    return await RETRIEVAL.retrieve(text)
 
 
 async def query_documents(text: str):
     try:
-        return await DB.asimilarity_search(text, k=DOCUMENTS_PER_QUERY)
+        return (await retrieve(text)).chunks
     except Exception as ex:
         logger.error(f"Error quering document embeddings. {ex}")
         return []
 
-
-class DocumentExtractor:
-
-    @staticmethod
-    def extract_plain(documents: list[Document]):
-        result = ""
-        for document in documents:
-            result += f"Контент:\n{document.metadata.get('Header 2', '')}\n{document.page_content}\n"
-            result += f"Название:{document.metadata.get('Header 1', 'Kia')}\n\n"
-        return result
-
-    @staticmethod
-    def extract_xml(documents: list[Document]):
-        result = "<document>\n"
-        for document in documents:
-            result += f"<content>\n{document.metadata.get('Header 2', '')}\n{document.page_content}\n</content>\n"
-            result += f"<source>\n{document.metadata.get('Header 1', 'Kia')}\n</source>\n"
-        result += "</document>\n\n"
-        return result
-
-    @staticmethod
-    def extract_dashed(documents: list[Document]):
-        result = ""
-        for i, doc in enumerate(documents):
-            content = doc.page_content
-            response = f'\n=====================Отрывок документа №{i + 1}=====================\n{content}\n'
-            result += response
-        return result
@@ -0,0 +1,205 @@
+import os
+import re
+import json
+import fcntl
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from typing import Optional
+from langchain.schema.embeddings import Embeddings
+
+from log import logger
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip().casefold()
+
+
+class DiskEmbeddingStore:
+    # Append-only records.bin: each record is a SHA-1 hex key followed by its float32 vector, read through np.memmap.
+    # A record is appended with a single write under an exclusive flock and its row is the file size at that moment,
+    # so a key can never point at another key's vector, whatever happened to earlier writes. Worker processes share
+    # the directory: records appended by the others are indexed before each append and on lookup misses.
+
+    KEY_BYTES = 40
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.meta_path = f"{directory}/meta.json"
+        self.records_path = f"{directory}/records.bin"
+        self.dim: Optional[int] = None
+        self.dtype: Optional[np.dtype] = None
+        self.rows: dict[str, int] = {}
+        self._indexed = 0
+        self._matrix: Optional[np.memmap] = None
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        if (row := self.rows.get(key)) is None and self.dtype is not None and os.path.exists(self.records_path):
+            self._index(os.path.getsize(self.records_path))
+            row = self.rows.get(key)
+        if row is None:
+            return None
+        if self._matrix is None or row >= self._matrix.shape[0]:
+            self._remap()
+        return np.array(self._matrix[row]["vector"])
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        if key in self.rows:
+            return
+        if self.dim is None:
+            self._set_dim(vector.shape[0])
+        record = np.zeros(1, dtype=self.dtype)
+        record["key"], record["vector"] = key, vector
+
+        with open(self.records_path, "ab") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(file.fileno()).st_size
+                if torn := size % self.dtype.itemsize:
+                    logger.warning(f"Dropping a torn {torn} byte record at the end of {self.records_path}")
+                    size -= torn
+                    file.truncate(size)
+                self._index(size)
+                if key in self.rows:
+                    return
+                file.write(record.tobytes())
+                file.flush()
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+        self.rows[key] = size // self.dtype.itemsize
+        self._indexed = max(self._indexed, self.rows[key] + 1)
+
+    def _set_dim(self, dim: int) -> None:
+        self.dim = dim
+        self.dtype = np.dtype([("key", f"S{self.KEY_BYTES}"), ("vector", "<f4", (dim,))])
+        if not os.path.exists(self.meta_path):
+            with open(tmp := f"{self.meta_path}.{os.getpid()}.tmp", "w") as file:
+                json.dump({"dim": dim}, file)
+            os.replace(tmp, self.meta_path)
+
+    def _load(self) -> None:
+        if not os.path.exists(self.meta_path):
+            return
+        with open(self.meta_path) as file:
+            self._set_dim(json.load(file)["dim"])
+        if os.path.exists(self.records_path):
+            self._index(os.path.getsize(self.records_path))
+
+    def _index(self, size: int) -> None:
+        # Records appended since the last call, a torn tail left by a crash is skipped until put truncates it.
+        rows = size // self.dtype.itemsize
+        if rows <= self._indexed:
+            return
+        self._remap(rows)
+        for row in range(self._indexed, rows):
+            key = self._matrix[row]["key"].decode("ascii", "replace")
+            if len(key) != self.KEY_BYTES or not all(c in "0123456789abcdef" for c in key):
+                logger.warning(f"Skipping corrupt record {row} in {self.records_path}")
+                continue
+            self.rows.setdefault(key, row)
+        self._indexed = rows
+
+    def _remap(self, rows: Optional[int] = None) -> None:
+        rows = os.path.getsize(self.records_path) // self.dtype.itemsize if rows is None else rows
+        if rows:
+            self._matrix = np.memmap(self.records_path, dtype=self.dtype, mode="r", shape=(rows,))
+
+
+class CachedEmbeddings(Embeddings):
+
+    def __init__(self, embeddings: Embeddings, model: str, max_size: int, disk_dir: Optional[str] = None, stats_every: int = 500) -> None:
+        self.embeddings = embeddings
+        self.model = model
+        self.max_size = max_size
+        self.stats_every = stats_every
+        self.disk = DiskEmbeddingStore(disk_dir) if disk_dir else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model}\0{normalize_text(text)}".encode()).hexdigest()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, vectors, missing = self._lookup(texts)
+        if missing:
+            self._store(keys, vectors, missing, self.embeddings.embed_documents([texts[i] for i in missing]))
+        return [vector.tolist() for vector in vectors]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, vectors, missing = self._lookup(texts)
+        if missing:
+            self._store(keys, vectors, missing, await self.embeddings.aembed_documents([texts[i] for i in missing]))
+        return [vector.tolist() for vector in vectors]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "memory_size": len(self._memory),
+            "disk_size": len(self.disk) if self.disk else 0,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+    def _lookup(self, texts: list[str]) -> tuple[list[str], list[Optional[np.ndarray]], list[int]]:
+        keys = [self.key(text) for text in texts]
+        vectors: list[Optional[np.ndarray]] = []
+        # Only the first of identical texts in a batch is embedded, the others count as hits and get its vector.
+        missing = []
+        first: set[str] = set()
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                elif self.disk is not None and (vector := self.disk.get(key)) is not None:
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                elif key in first:
+                    self.hits += 1
+                else:
+                    first.add(key)
+                    missing.append(i)
+                    self.misses += 1
+                vectors.append(vector)
+            self._maybe_log(len(texts))
+        return keys, vectors, missing
+
+    def _store(self, keys: list[str], vectors: list[Optional[np.ndarray]], missing: list[int], embedded: list[list[float]]) -> None:
+        fresh = {}
+        with self._lock:
+            for i, embedding in zip(missing, embedded):
+                fresh[keys[i]] = vector = np.asarray(embedding, dtype=np.float32)
+                self._remember(keys[i], vector)
+                if self.disk is not None:
+                    self.disk.put(keys[i], vector)
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                vectors[i] = fresh[keys[i]]
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _maybe_log(self, count: int) -> None:
+        lookups = self.hits + self.disk_hits + self.misses
+        if lookups // self.stats_every != (lookups - count) // self.stats_every:
+            logger.info(f"Embedding cache stats {self.stats()}")
@@ -0,0 +1,15 @@
+import asyncio
+import argparse
+
+from .db import rebuild_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-embed changed chunks of the knowledge base and swap the FAISS index in.")
+    parser.add_argument("--force", action="store_true", help="re-embed every chunk")
+    args = parser.parse_args()
+    print(asyncio.run(rebuild_index(force=args.force)))
+
+
+if __name__ == "__main__":
+    main()
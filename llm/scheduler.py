@@ -0,0 +1,170 @@
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import email.utils
+import openai
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from log import logger
+
+T = TypeVar("T")
+
+
+class Priority:
+    ANSWER = 0
+    SUMMARY = 1
+
+
+class TokenBucket:
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # Requests bigger than the whole bucket are let through once it is full instead of waiting forever.
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+    def drain(self) -> None:
+        self._refill()
+        self.level = min(self.level, 0)
+
+
+class RequestScheduler:
+    # Admits OpenAI requests in priority order while request and token budgets and the concurrency limit allow.
+
+    RETRYABLE = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+    def __init__(self, rpm: int, tpm: int, max_concurrency: int, max_retries: int, base_delay: float, max_delay: float) -> None:
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.active = 0
+        self.throttled = 0
+        self.retries = 0
+        self._paused_until = 0.0
+        self._waiters: list[tuple[int, int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def stats(self) -> dict[str, Any]:
+        return {"active": self.active, "queued": self.queued, "throttled": self.throttled, "retries": self.retries}
+
+    @asynccontextmanager
+    async def slot(self, priority: int, tokens: int) -> AsyncIterator[None]:
+        await self._acquire(priority, tokens)
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._pump()
+
+    def settle(self, estimated: int, actual: int) -> None:
+        self.tokens.consume(actual - estimated)
+
+    async def run(self, priority: int, tokens: int, call: Callable[[], Awaitable[T]]) -> T:
+        for attempt in itertools.count():
+            async with self.slot(priority, tokens):
+                try:
+                    return await call()
+                except Exception as error:
+                    if (delay := self.retry_delay(error, attempt)) is None:
+                        raise
+            await asyncio.sleep(delay)
+
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        if not isinstance(error, self.RETRYABLE) or attempt >= self.max_retries:
+            return None
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if (retry_after := self._retry_after(error)) is not None:
+            delay = retry_after + random.uniform(0, self.base_delay)
+
+        if isinstance(error, openai.RateLimitError):
+            # The quota is shared by every request, so everyone waits out a 429.
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self.requests.drain()
+
+        self.retries += 1
+        logger.warning(f"OpenAI request failed ({type(error).__name__}), retry {attempt + 1} in {delay:.1f}s")
+        return delay
+
+    async def _acquire(self, priority: int, tokens: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), tokens, future))
+        self._pump()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.active -= 1
+                self._pump()
+            raise
+
+    def _pump(self) -> None:
+        while self._waiters and self.active < self.max_concurrency:
+            priority, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+
+            wait = max(self._paused_until - time.monotonic(), self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait > 0:
+                self._schedule(wait)
+                return
+
+            heapq.heappop(self._waiters)
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+            self.active += 1
+            future.set_result(None)
+
+    def _schedule(self, wait: float) -> None:
+        if self._timer is not None and not self._timer.cancelled():
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(wait, self._pump)
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        if (value := response.headers.get("retry-after-ms")) is not None:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+        if (value := response.headers.get("retry-after")) is not None:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+        return None
@@ -1,14 +1,43 @@
 import os
+import sys
+import time
+import queue
 import pathlib
-import threading
 import requests
+import multiprocessing
+from collections import OrderedDict
 from dotenv import load_dotenv
-from logging import Handler, LogRecord
+from logging import Handler, LogRecord, makeLogRecord
+from logging.handlers import QueueListener
 
 load_dotenv(".env")
 
 BOT_TOKEN = os.environ.get("LOGGING_BOT_TOKEN")
-END_USERS = os.environ.get("LOGGING_END_USERS").split(",")
+END_USERS = [user for user in os.environ.get("LOGGING_END_USERS", "").split(",") if user]
+
+# Put on the queue by LogListener when it has been idle for a while, so buffered handlers get to flush.
+FLUSH = makeLogRecord({"msg": "flush"})
+
+
+class LogListener(QueueListener):
+    # Expects a queue.SimpleQueue: the idle FLUSH record must not be followed by task_done().
+
+    def __init__(self, log_queue: queue.SimpleQueue, *handlers: Handler, flush_interval: float = 1.0) -> None:
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block: bool) -> LogRecord:
+        try:
+            return self.queue.get(block, self.flush_interval)
+        except queue.Empty:
+            return FLUSH
+
+    def handle(self, record: LogRecord) -> None:
+        if record is FLUSH:
+            for handler in self.handlers:
+                handler.flush()
+            return
+        super().handle(record)
 
 
 class ConsoleHandler(Handler):
@@ -29,45 +58,140 @@ class ConsoleHandler(Handler):
         print(color + message + self._END)
 
 
+def cut_middle(text: str, limit: int) -> str:
+    # Keeps the log line and the end of the traceback, where the exception is.
+    marker = "\n…\n"
+    if len(text) <= limit:
+        return text
+    if limit <= len(marker):
+        return text[:limit]
+    head = (limit - len(marker)) // 3
+    return text[:head] + marker + text[len(text) - (limit - len(marker) - head):]
+
+
 class FileHandler(Handler):
-    def __init__(self, filename: str) -> None:
+    # Runs on its listener thread: records are appended in batches and the file is rotated by size.
+    # Rotation renames the file, so every process needs its own: worker processes write bot.worker-N.log.
+    queued = True
+
+    def __init__(self, filename: str, max_bytes: int = 10 * 2 ** 20, backup_count: int = 5, batch_size: int = 100, flush_interval: float = 1.0) -> None:
         super().__init__()
         self.filename = filename
+        self.path = f"{pathlib.Path(__file__).parent}/{filename}"
+        if (process := multiprocessing.current_process().name) != "MainProcess":
+            stem, suffix = os.path.splitext(self.path)
+            self.path = f"{stem}.{process}{suffix}"
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: list[str] = []
+        self._flushed = time.monotonic()
+        self._file = None
 
     def emit(self, record: LogRecord) -> None:
-        message = self.format(record) + "\n"
-
-        threading.Thread(
-            target=self.file_append,
-            args=(message,),
-            name="fileLoggingThread"
-        ).start()
-
-    def file_append(self, message: str):
-        dir = pathlib.Path(__file__).parent
-        path = f"{dir}/{self.filename}"
-
-        with open(path, "a") as file:
-            file.write(message)
+        self._buffer.append(self.format(record) + "\n")
+        if len(self._buffer) >= self.batch_size or time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self._flushed = time.monotonic()
+        if not self._buffer:
+            return
+        data = "".join(self._buffer).encode()
+        self._buffer.clear()
+        try:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            if self.max_bytes and self._file.tell() and self._file.tell() + len(data) > self.max_bytes:
+                self.rotate()
+            self._file.write(data)
+            self._file.flush()
+        except OSError as ex:
+            sys.stderr.write(f"Couldn't write log file {self.path}. {ex}\n")
+
+    def rotate(self) -> None:
+        self._file.close()
+        for number in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(source := f"{self.path}.{number}"):
+                os.replace(source, f"{self.path}.{number + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "wb")
+
+    def close(self) -> None:
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        super().close()
 
 
 class TelegramHandler(Handler):
-    def __init__(self, project_name: str) -> None:
+    # Runs on its listener thread: alerts are collected for interval seconds, repeats of one log call
+    # are collapsed into a counter and each batch goes out as one message over a pooled session.
+    # A batch that would go over Telegram's message length limit has its longest alerts shortened.
+    queued = True
+    flush_interval = 1.0
+    MAX_LENGTH = 4096
+
+    def __init__(self, project_name: str, interval: float = 30.0, max_batch: int = 10, timeout: float = 10.0) -> None:
         super().__init__()
         self.project_name = project_name
+        self.interval = interval
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._pending: OrderedDict[tuple, list] = OrderedDict()
+        self._sent = 0.0
 
     def emit(self, record: LogRecord) -> None:
-        if BOT_TOKEN is not None:
+        if BOT_TOKEN is None:
+            return
+        key = (record.pathname, record.lineno)
+        if key in self._pending:
+            self._pending[key][1] += 1
+        else:
             message = self.format(record).replace("<", " ").replace(">", " ")
-            message = f"<b>{self.project_name}:</b>\n{message}"
-
-            threading.Thread(
-                target=self.send_message,
-                args=(message,),
-                name="fileLoggingThread"
-            ).start()
+            self._pending[key] = [cut_middle(message, self.MAX_LENGTH), 1]
+        self.flush()
+
+    def flush(self) -> None:
+        if not self._pending or time.monotonic() - self._sent < self.interval:
+            return
+        self._sent = time.monotonic()
+        alerts = list(self._pending.values())
+        self._pending.clear()
+
+        header = f"<b>{self.project_name}:</b>\n"
+        more = f"\n\n<i>and {len(alerts) - self.max_batch} more</i>" if len(alerts) > self.max_batch else ""
+        alerts = alerts[:self.max_batch]
+        suffixes = ["" if count == 1 else f"\n<i>repeated {count} times</i>" for _, count in alerts]
+        budget = self.MAX_LENGTH - len(header) - len(more) - 2 * (len(alerts) - 1) - sum(map(len, suffixes))
+        texts = self.fit([message for message, _ in alerts], budget)
+        self.send_message(header + "\n\n".join(text + suffix for text, suffix in zip(texts, suffixes)) + more)
+
+    @staticmethod
+    def fit(texts: list[str], budget: int) -> list[str]:
+        # Alerts shorter than an equal share stay whole, the longer ones split what they leave over.
+        limits = {}
+        remaining = budget
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for n, i in enumerate(order):
+            limits[i] = min(len(texts[i]), max(0, remaining) // (len(order) - n))
+            remaining -= limits[i]
+        return [cut_middle(text, limits[i]) for i, text in enumerate(texts)]
 
     def send_message(self, message: str):
         for user_id in END_USERS:
-            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage?chat_id={user_id}&text={message}&parse_mode=HTML"
-            resp = requests.get(url)
+            try:
+                self.session.post(f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage", timeout=self.timeout,
+                                  data={"chat_id": user_id, "text": message, "parse_mode": "HTML"})
+            except requests.RequestException as ex:
+                sys.stderr.write(f"Couldn't send log alert to {user_id}. {ex}\n")
+
+    def close(self) -> None:
+        self._sent = 0.0
+        self.flush()
+        self.session.close()
+        super().close()
@@ -1,5 +1,8 @@
 import json
+import queue
+import atexit
 import logging.config
+from logging.handlers import QueueHandler
 from . import handlers
 
 
@@ -8,3 +11,27 @@ with open("log/conf.json", "r") as file:
 
 logging.config.dictConfig(config)
 logger = logging.getLogger("app_logger")
+
+# Slow handlers get a queue and a listener thread each, logging calls only enqueue the record.
+LISTENERS: list[handlers.LogListener] = []
+for handler in list(logger.handlers):
+    if getattr(handler, "queued", False):
+        log_queue = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.setLevel(handler.level)
+        logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        LISTENERS.append(handlers.LogListener(log_queue, handler, flush_interval=handler.flush_interval))
+
+
+def stop_listeners():
+    for listener in LISTENERS:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+    LISTENERS.clear()
+
+
+for listener in LISTENERS:
+    listener.start()
+atexit.register(stop_listeners)
@@ -1,15 +1,50 @@
+import time
+# Taken before the heavy imports below, so the startup time in the log includes them.
+STARTED = time.perf_counter()
+
 import os
+import json
+import signal
 import asyncio
+from typing import Any, Callable, Optional
+from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 from bot.handlers import register_handlers
-from bot.middlewares import register_middlewares
+from bot.middlewares import IN_FLIGHT, register_middlewares
+from bot.outbound import SEND_QUEUE
+from bot.summarizer import SUMMARIZER
+from bot.supervisor import Supervisor
 from db import UserDatabase
+from llm import LLM
+from llm.db import index_fingerprint, rebuild_index, warm_up, watch_index
 from log import logger
+from metrics import start_server
 
 load_dotenv(".env")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# A local Bot API server, or the load test's stand-in.
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+with open("conf.json", "r") as file:
+    logger.debug("Loading metrics and bot mode config")
+    conf = json.load(file)
+    METRICS_CONFIG = conf["METRICS"]
+    BOT_CONFIG = conf["BOT"]
+
+MODE = os.getenv("BOT_MODE", BOT_CONFIG["MODE"])
+WEBHOOK_CONFIG = BOT_CONFIG["WEBHOOK"]
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", WEBHOOK_CONFIG["URL"])
+WORKERS_CONFIG = BOT_CONFIG["WORKERS"]
+WORKERS = int(os.getenv("BOT_WORKERS", WORKERS_CONFIG["COUNT"]))
+# Set in worker processes, each serves its metrics on METRICS.PORT + WORKER.
+WORKER: Optional[int] = None
 
 dp = Dispatcher()
 
@@ -17,11 +52,152 @@ register_handlers(dp)
 register_middlewares(dp)
 
 
-async def main():
-    bot = Bot(BOT_TOKEN)
+BACKGROUND: list[asyncio.Task] = []
+SERVERS: list[web.AppRunner] = []
+
+
+async def on_startup(bot: Bot):
+    await UserDatabase.create()
+    if not WORKER:
+        UserDatabase.start_maintenance()
+    await LLM.create()
+    BACKGROUND.append(asyncio.create_task(warm_up()))
+    BACKGROUND.append(asyncio.create_task(watch_index()))
+    SUMMARIZER.start()
+    if METRICS_CONFIG["ENABLED"]:
+        SERVERS.append(await start_server(METRICS_CONFIG["HOST"], METRICS_CONFIG["PORT"] + (WORKER or 0)))
+    if WORKER is None:
+        logger.info(f"{MODE.capitalize()} beginning, startup took {time.perf_counter() - STARTED:.2f}s")
+    else:
+        logger.info(f"Worker {WORKER} ready, startup took {time.perf_counter() - STARTED:.2f}s")
+
+
+async def on_shutdown():
+    # Polling has stopped or the webhook server no longer accepts requests, let the running handlers finish
+    # before the summarizer, LLM clients and the write-behind queue are shut down.
+    if IN_FLIGHT.count:
+        logger.info(f"Waiting for {IN_FLIGHT.count} updates in flight")
+        if not await IN_FLIGHT.drain(BOT_CONFIG["DRAIN_TIMEOUT"]):
+            logger.warning(f"{IN_FLIGHT.count} updates still in flight after {BOT_CONFIG['DRAIN_TIMEOUT']}s, shutting down anyway")
+    await SEND_QUEUE.stop()
+    for task in BACKGROUND:
+        task.cancel()
+    BACKGROUND.clear()
+    for server in SERVERS:
+        await server.cleanup()
+    SERVERS.clear()
+    await SUMMARIZER.stop(BOT_CONFIG["DRAIN_TIMEOUT"])
+    await LLM.close()
+    await UserDatabase.close()
+
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+
+def make_bot() -> Bot:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else AiohttpSession()
+    session.middleware(SEND_QUEUE)
+    return Bot(BOT_TOKEN, session=session)
+
+
+async def prepare_workers():
+    # Migrations and a missing index are handled once here instead of racing in every worker.
     await UserDatabase.create()
-    logger.info("Polling beginning")
-    await dp.start_polling(bot)
+    await UserDatabase.close()
+    if not index_fingerprint():
+        logger.info("No FAISS index found, building it before starting workers")
+        await rebuild_index(force=True)
+
+
+def make_supervisor(workers: int, target: Optional[Callable[[int, int, Any], None]] = None) -> Supervisor:
+    supervisor = Supervisor(workers, target or run_worker, WORKERS_CONFIG["RESTART_DELAY"], WORKERS_CONFIG["STOP_TIMEOUT"])
+    supervisor.dispatcher.startup.register(prepare_workers)
+    supervisor.dispatcher.startup.register(supervisor.start)
+    supervisor.dispatcher.shutdown.register(supervisor.stop)
+    return supervisor
+
+
+def run_worker(number: int, workers: int, updates):
+    asyncio.run(worker(number, workers, updates))
+
+
+async def worker(number: int, workers: int, updates):
+    global WORKER
+    WORKER = number
+    SEND_QUEUE.share(workers)
+    # Ctrl+C reaches the whole process group, workers stop when the supervisor sends None.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, updates.put, None)
+    bot = make_bot()
+    await dp.emit_startup(bot=bot)
+    tasks: set[asyncio.Task] = set()
+    # The last update of each user still running, the next one of the same user waits for it.
+    chains: dict[int, asyncio.Task] = {}
+    try:
+        while (raw := await loop.run_in_executor(None, updates.get)) is not None:
+            update = Update.model_validate_json(raw, context={"bot": bot})
+            user = getattr(update.event, "from_user", None)
+            previous = chains.get(user.id) if user is not None else None
+            task = asyncio.create_task(handle_update(bot, update, previous))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if user is not None:
+                chains[user.id] = task
+                task.add_done_callback(lambda done, user_id=user.id: chains.pop(user_id) if chains.get(user_id) is done else None)
+    finally:
+        if tasks:
+            await asyncio.wait(tasks, timeout=BOT_CONFIG["DRAIN_TIMEOUT"])
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
+async def handle_update(bot: Bot, update: Update, after: Optional[asyncio.Task] = None):
+    if after is not None:
+        await asyncio.wait([after])
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as ex:
+        logger.error(f"Error handling update {update.update_id} in worker {WORKER}. {ex}")
+
+
+def webhook_app(bot: Bot, dispatcher: Dispatcher = dp) -> web.Application:
+    # The dispatcher's shutdown is registered before the request handler's, so in-flight updates are drained
+    # while the bot session is still open.
+    app = web.Application()
+    setup_application(app, dispatcher, bot=bot)
+    SimpleRequestHandler(dispatcher, bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_CONFIG["PATH"])
+    if WEBHOOK_URL:
+        app.on_startup.append(lambda app: bot.set_webhook(WEBHOOK_URL + WEBHOOK_CONFIG["PATH"], secret_token=WEBHOOK_SECRET,
+                                                          allowed_updates=dp.resolve_used_update_types()))
+    return app
+
+
+async def run_webhook(bot: Bot, dispatcher: Dispatcher):
+    runner = web.AppRunner(webhook_app(bot, dispatcher), access_log=None)
+    await runner.setup()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stopping.set)
+    try:
+        await web.TCPSite(runner, WEBHOOK_CONFIG["HOST"], WEBHOOK_CONFIG["PORT"]).start()
+        logger.info(f"Serving webhook on http://{WEBHOOK_CONFIG['HOST']}:{WEBHOOK_CONFIG['PORT']}{WEBHOOK_CONFIG['PATH']}")
+        await stopping.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def main():
+    bot = make_bot()
+    # With workers this process only receives updates, handlers and their startup run in the workers.
+    dispatcher = make_supervisor(WORKERS).dispatcher if WORKERS else dp
+    if MODE == "webhook":
+        await run_webhook(bot, dispatcher)
+    else:
+        # getUpdates is refused while a webhook is set, e.g. after switching back from webhook mode.
+        await bot.delete_webhook()
+        await dispatcher.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,2 @@
+from .registry import METRICS
+from .server import start_server
@@ -0,0 +1,146 @@
+import time
+import bisect
+import functools
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+from log import logger
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def format_labels(labels: Labels, **extra: str) -> str:
+    pairs = [*labels, *extra.items()]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        # Linear interpolation inside the bucket holding the rank, as Prometheus' histogram_quantile does.
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Registry:
+    # Updated from the event loop thread only, so observations go without locks.
+
+    def __init__(self, prefix: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.prefix = prefix
+        self.buckets = buckets
+        self.histograms: dict[str, dict[Labels, Histogram]] = {}
+        self.counters: dict[str, dict[Labels, float]] = {}
+        self._gauges: list[tuple[str, Callable[[], dict[str, Any]]]] = []
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        if (histogram := series.get(key)) is None:
+            histogram = series[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0.0) + value
+
+    @contextmanager
+    def span(self, name: str, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name: str, **labels: str) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    def gauges_from(self, name: str, stats: Callable[[], dict[str, Any]]) -> None:
+        # stats() is read at scrape time, nested dicts are flattened and non-numeric values skipped.
+        self._gauges.append((name, stats))
+
+    def gauges(self) -> dict[str, float]:
+        result = {}
+        for name, stats in self._gauges:
+            try:
+                self._flatten(name, stats(), result)
+            except Exception as ex:
+                logger.warning(f"Couldn't collect {name} stats. {ex}")
+        return result
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {self.prefix}_{name} histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{self.prefix}_{name}_bucket{format_labels(labels, le=repr(bound))} {cumulative}")
+                lines.append(f"{self.prefix}_{name}_bucket{format_labels(labels, le='+Inf')} {histogram.count}")
+                lines.append(f"{self.prefix}_{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{self.prefix}_{name}_count{format_labels(labels)} {histogram.count}")
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{name} counter")
+            lines.extend(f"{self.prefix}_{name}{format_labels(labels)} {value}" for labels, value in series.items())
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines = []
+        for name, series in sorted(self.histograms.items()):
+            for labels, histogram in sorted(series.items()):
+                mean = histogram.sum / histogram.count if histogram.count else 0.0
+                lines.append(f"{name}{format_labels(labels)}: n={histogram.count} mean={mean * 1e3:.0f}ms "
+                             f"p50={histogram.quantile(0.5) * 1e3:.0f}ms p95={histogram.quantile(0.95) * 1e3:.0f}ms "
+                             f"p99={histogram.quantile(0.99) * 1e3:.0f}ms")
+        for name, series in sorted(self.counters.items()):
+            lines.extend(f"{name}{format_labels(labels)}: {value:g}" for labels, value in sorted(series.items()))
+        lines.extend(f"{name}: {value:g}" for name, value in sorted(self.gauges().items()))
+        return "\n".join(lines)
+
+    @classmethod
+    def _flatten(cls, name: str, stats: dict[str, Any], result: dict[str, float]) -> None:
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                cls._flatten(f"{name}_{key}", value, result)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                result[f"{name}_{key}"] = value
+
+
+METRICS = Registry("kia_bot")
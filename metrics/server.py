@@ -0,0 +1,18 @@
+from aiohttp import web
+
+from log import logger
+from .registry import METRICS
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=METRICS.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner